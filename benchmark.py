@@ -0,0 +1,852 @@
+#!/usr/bin/python
+import sys, getopt, os, subprocess, time, json, csv, random, tempfile, shutil
+import bisect, locale, resource, StringIO, types
+from datetime import datetime, timedelta
+
+# Benchmarks for expensifier.py. Each run prints its timings and can
+# append them to a results file (one JSON object per line), and compare
+# them against the last run of the same benchmark, with the same
+# parameters, saved there, so that a regression fails the run.
+#
+# "generate" writes the synthetic Expensify dumps the benchmarks use, for
+# trying things out by hand.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import expensifier
+fnExpensifier = os.path.abspath(expensifier.__file__).replace('.pyc', '.py')
+
+expensifyFields = ['Timestamp', 'Merchant', 'Amount', 'MCC', 'Category', \
+	'Tag', 'Comment', 'Reimbursable', 'Original Currency', \
+	'Original Amount', 'Receipt']
+
+# Made-up exchange rates from the home currency, for foreign expenses
+exchangeRates = {'USD':1.0, 'EUR':0.9, 'GBP':0.8, 'CAD':1.3, 'JPY':110.0}
+
+# What goes into a synthetic dump. categories and currencies are lists of
+# (name, weight); the first currency is the home currency, the one
+# Expensify converted everything to. Categories must be ones the tool
+# takes, as Expensify writes them, e.g. "Transport - Taxi".
+class DumpSpec:
+	def __init__(self, rows = 100000, \
+			categories = None, currencies = None, \
+			locale = 'C', days = 365, seed = 0):
+		self.rows = rows
+		if categories == None:
+			categories = [(category, 1) for category in \
+				sorted(expensifier.ExpensifyFormatV1().getExpensifyCategories())]
+		self.setCategories(categories)
+		if currencies == None:
+			currencies = [('USD', 8), ('EUR', 1), ('GBP', 1)]
+		self.currencies = currencies
+		self.locale = locale
+		self.days = days
+		self.seed = seed
+
+	def setCategories(self, categories):
+		unknown = [name for (name, weight) in categories if name not in \
+			expensifier.ExpensifyFormatV1.mapExpensifyFieldToExpenseType]
+		if len(unknown) > 0:
+			raise ValueError('not Expensify categories: ' + \
+				', '.join('"%s"' % name for name in unknown))
+		self.categories = categories
+
+	def homeCurrency(self):
+		return self.currencies[0][0]
+
+	def parameters(self):
+		return {'rows':self.rows, 'locale':self.locale, 'days':self.days, \
+			'categories':self.categories, 'currencies':self.currencies, \
+			'seed':self.seed}
+
+# "name=weight,name=weight", weight defaulting to 1
+def parseMix(text):
+	mix = []
+	for item in text.split(','):
+		name, sep, weight = item.partition('=')
+		mix.append((name.strip(), float(weight) if sep else 1.0))
+	return mix
+
+# Weighted random choice from a mix, by bisecting the cumulative weights
+class MixChooser:
+	def __init__(self, mix, rng):
+		self.names = [name for (name, weight) in mix]
+		self.cumulative = []
+		total = 0.0
+		for name, weight in mix:
+			total += weight
+			self.cumulative.append(total)
+		self.rng = rng
+
+	def choose(self):
+		return self.names[bisect.bisect_right(self.cumulative, \
+			self.rng.random() * self.cumulative[-1])]
+
+# Write a synthetic dump, in timestamp order, spread evenly over
+# spec.days days, with amounts formatted for spec.locale
+def writeDump(fnDump, spec):
+	rng = random.Random(spec.seed)
+	categories = MixChooser(spec.categories, rng)
+	currencies = MixChooser(spec.currencies, rng)
+	home = spec.homeCurrency()
+	start = datetime(2015, 1, 1)
+	step = spec.days * 86400.0 / max(spec.rows, 1)
+
+	previousLocale = locale.setlocale(locale.LC_ALL)
+	locale.setlocale(locale.LC_ALL, spec.locale)
+	try:
+		with open(fnDump, 'wb') as fDump:
+			w = csv.writer(fDump)
+			w.writerow(expensifyFields)
+			for i in xrange(spec.rows):
+				currency = currencies.choose()
+				amount = round(rng.uniform(1, 2000), 2)
+				if currency == home:
+					origAmount = amount
+				else:
+					origAmount = round(amount * \
+						exchangeRates.get(currency, 1.5) / \
+						exchangeRates.get(home, 1.5), 2)
+					if origAmount == amount:
+						origAmount += 0.01
+				w.writerow([ \
+					(start + timedelta(seconds = int(i * step))).strftime( \
+						'%Y-%m-%d %H:%M:%S'), \
+					'Merchant %d' % rng.randint(1, 5000), \
+					locale.format('%.2f', amount, grouping = True), \
+					'0', \
+					categories.choose(), \
+					'', \
+					'Expense %d' % i, \
+					'yes', \
+					currency, \
+					locale.format('%.2f', origAmount, grouping = True), \
+					''])
+	finally:
+		locale.setlocale(locale.LC_ALL, previousLocale)
+
+def v3Layout():
+	return expensifier.reportLayout(expensifier.defaultLayoutName)
+
+# A stand-in for the blank expense form: just the right sheet name.
+# .xlsx ones are written out by hand, as xlwt can't.
+def writeTemplate(fnTemplate):
+	if fnTemplate.endswith('.xlsx'):
+		return writeXlsxTemplate(fnTemplate)
+	expensifier.loadSpreadsheetModules()
+	wb = expensifier.xlwt.Workbook()
+	st = wb.add_sheet(v3Layout().sheetName)
+	st.write(0, 0, 'Expense Report')
+	wb.save(fnTemplate)
+
+xlsxTemplateParts = [ \
+	('[Content_Types].xml', '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+		'<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">' \
+		'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>' \
+		'<Default Extension="xml" ContentType="application/xml"/>' \
+		'<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>' \
+		'<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' \
+		'</Types>'), \
+	('_rels/.rels', '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+		'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' \
+		'<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>' \
+		'</Relationships>'), \
+	('xl/workbook.xml', '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+		'<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" ' \
+		'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">' \
+		'<sheets><sheet name="%(sheetName)s" sheetId="1" r:id="rId1"/></sheets>' \
+		'</workbook>'), \
+	('xl/_rels/workbook.xml.rels', '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+		'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' \
+		'<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>' \
+		'</Relationships>'), \
+	('xl/worksheets/sheet1.xml', '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+		'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">' \
+		'<sheetData><row r="1"><c r="A1" t="inlineStr"><is><t>Expense Report</t></is></c></row></sheetData>' \
+		'</worksheet>')]
+
+def writeXlsxTemplate(fnTemplate):
+	import zipfile
+	with zipfile.ZipFile(fnTemplate, 'w', zipfile.ZIP_DEFLATED) as zf:
+		for name, data in xlsxTemplateParts:
+			zf.writestr(name, data % \
+				{'sheetName':expensifier.xlsxEscape(v3Layout().sheetName)})
+
+# An ExpenseV3 with every section full, attached to a copy of the template
+def fullExpenseSheet(template):
+	config = expensifier.ReportConfig('Benchmark', 'USD', 0.0, 'C')
+	xpen = expensifier.ExpenseV3(None, None, None, config)
+	types = ['breakfast', 'lunch', 'dinner', 'hotel', 'air', 'taxi', 'phone']
+	for day in range(xpen.layout.travel.rows):
+		for expenseType in types:
+			xpen.combine(expensifier.Expense(expenseType, \
+				datetime(2015, 1, day + 1).date(), 'Travel', 10.0, \
+				'Merchant', 'EUR', 9.0))
+	for i in range(xpen.layout.entertainment.rows):
+		xpen.combine(expensifier.Expense('entertainment', \
+			datetime(2015, 1, 1).date(), 'Dinner', 50.0, 'Merchant', \
+			'USD', 50.0))
+	for i in range(xpen.layout.miscellaneous.rows):
+		xpen.combine(expensifier.Expense('miscellaneous', \
+			datetime(2015, 1, 2).date(), 'Books', 20.0, 'Merchant', \
+			'USD', 20.0))
+	xpen.addCurrencyCostExpense()
+	template.attachExpenseSheetCopy(xpen)
+	return xpen
+
+# How sheets were filled in before the layout was compiled into (row, col)
+# tables: an "A12" string built and parsed for every cell. Kept here to
+# measure against.
+def legacyWriteSheet(xpen):
+	e = expensifier
+	def writer(st, address, value, style = None):
+		if style == None:
+			style = e.textStyle
+		r, c = e.addressConvert(address)
+		st.write(r, c, value, style)
+
+	st = xpen.st
+	layout = xpen.layout
+	columnLetters = dict((category, chr(ord('A') + col)) \
+		for (category, col) in layout.travel.categoryColumns)
+	for rowIndex, exp in enumerate(xpen.travelExp.getAccumulators()):
+		row = layout.travel.firstRow + rowIndex
+		writer(st, 'A' + str(row), str(exp.date))
+		writer(st, 'B' + str(row), str(exp.description))
+		for category, column in columnLetters.iteritems():
+			if category in exp.expenseMap:
+				writer(st, column + str(row), exp.expenseMap[category], \
+					e.currencyStyle)
+	for rowIndex, exp in enumerate(xpen.entertainmentExp.getValues()):
+		row = layout.entertainment.firstRow + rowIndex
+		writer(st, 'A' + str(row), str(exp.date))
+		writer(st, 'B' + str(row), e.BUSINESSPURPOSE)
+		writer(st, 'D' + str(row), str(exp.description))
+		writer(st, 'J' + str(row), str(exp.merchant))
+		writer(st, 'P' + str(row), exp.amount, e.currencyStyle)
+	for rowIndex, exp in enumerate(xpen.miscellaneousExp.getValues()):
+		row = layout.miscellaneous.firstRow + rowIndex
+		writer(st, 'A' + str(row), str(exp.date))
+		writer(st, 'B' + str(row), str(exp.merchant) + ': ' + str(exp.description))
+		writer(st, 'F' + str(row), e.DEPARTMENT)
+		writer(st, 'H' + str(row), exp.amount, e.currencyStyle)
+	currency = xpen.config.homeCurrency
+	writer(st, 'O29', currency)
+	writer(st, 'B44', 'TOTAL EXPENSE ' + currency)
+	writer(st, 'E44', 'Not Applicable - Reimbursement in ' + currency)
+	writer(st, 'G44', 'Not Applicable - Reimbursement in ' + currency)
+	writer(st, 'H1', e.BUSINESSPURPOSE)
+	writer(st, 'M1', xpen.config.yourName)
+	writer(st, 'N2', e.DEPARTMENT)
+	writer(st, 'N3', str(xpen.low) + ' to ' + str(xpen.high))
+	writer(st, 'E48', str(datetime.today().date()))
+
+# How Expense was before it had __slots__ and interned strings. Kept here
+# to measure against.
+class LegacyExpense:
+	def __init__(self, expenseType, date, description, amount, merchant, origCurrency, origAmount):
+		self.expenseType = expenseType
+		self.date = date
+		self.description = description
+		self.amount = float(amount)
+		self.merchant = merchant
+		self.origCurrency = origCurrency
+		self.origAmount = float(origAmount)
+
+# Bytes taken by obj and everything it refers to, counting anything
+# shared (an interned string, say) once. Classes, modules and functions
+# aren't counted: they're there however many objects there are.
+def deepSize(obj):
+	shared = (type, types.ClassType, types.ModuleType, types.FunctionType, \
+		types.BuiltinFunctionType)
+	seen = set()
+	pending = [obj]
+	size = 0
+	while len(pending) > 0:
+		obj = pending.pop()
+		if id(obj) in seen or isinstance(obj, shared):
+			continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			pending.extend(obj.keys())
+			pending.extend(obj.values())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			pending.extend(obj)
+		if hasattr(obj, '__dict__'):
+			pending.append(obj.__dict__)
+		for cls in type(obj).__mro__:
+			for slot in cls.__dict__.get('__slots__', ()):
+				if hasattr(obj, slot):
+					pending.append(getattr(obj, slot))
+	return size
+
+# Wall time of each of repeats runs of a function, in ms
+def timeFunction(f, repeats):
+	times = []
+	for i in range(repeats):
+		t = time.time()
+		f()
+		times.append((time.time() - t) * 1000.0)
+	return times
+
+# Wall time of each of repeats runs of a command, in ms
+def timeCommand(argv, repeats):
+	times = []
+	with open(os.devnull, 'wb') as devnull:
+		for i in range(repeats):
+			t = time.time()
+			status = subprocess.call(argv, stdout = devnull, stderr = devnull)
+			times.append((time.time() - t) * 1000.0)
+			if status != 0:
+				raise Exception('%s exited with %d' % (' '.join(argv), status))
+	return times
+
+def describeTimes(times):
+	times = sorted(times)
+	return {'min':round(times[0], 2), \
+		'median':round(times[len(times) / 2], 2), \
+		'max':round(times[-1], 2)}
+
+# Wall time for "expensifier.py -h" and for a dry run of a small dump,
+# both of which should stay well clear of the spreadsheet modules
+def benchStartup(options):
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnDump = os.path.join(tmpDir, 'startup.csv')
+		writeDump(fnDump, DumpSpec(rows = 100, currencies = [('USD', 1)]))
+		return {'timings':{ \
+			'help':describeTimes(timeCommand( \
+				[sys.executable, fnExpensifier, '-h'], options.repeats)), \
+			'dryRun':describeTimes(timeCommand( \
+				[sys.executable, fnExpensifier, '-l', 'C', '--dry-run', \
+				'Startup Benchmark', fnDump], options.repeats)) \
+		}}
+	finally:
+		shutil.rmtree(tmpDir)
+
+# Filling in every cell of a full sheet (no save), with the compiled
+# layout tables and batched writer, and the old string-address way
+def benchCellWrite(options):
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnTemplate = os.path.join(tmpDir, 'template.xls')
+		writeTemplate(fnTemplate)
+		template = expensifier.ExpenseTemplate(fnTemplate)
+	finally:
+		shutil.rmtree(tmpDir)
+	xpen = fullExpenseSheet(template)
+
+	# each timing fills in the same sheet 100 times, so the cells are
+	# already there after the first and we only measure the writing
+	sheets = 100
+	def compiled():
+		for i in range(sheets):
+			xpen.writeSheet(expensifier.writer)
+	def legacy():
+		for i in range(sheets):
+			legacyWriteSheet(xpen)
+	return {'timings':{ \
+		'compiled100':describeTimes(timeFunction(compiled, options.repeats)), \
+		'legacy100':describeTimes(timeFunction(legacy, options.repeats)) \
+	}}
+
+# Making whole sheets with each output backend, .xls and .xlsx: loading
+# the template, and then for options.sampleSheets full sheets, giving
+# each its copy of the form, filling in the cells and saving it to memory
+def benchFormats(options):
+	timings = {}
+	throughput = {}
+	sizes = {}
+	tmpDir = tempfile.mkdtemp()
+	try:
+		for extension in sorted(expensifier.outputBackends):
+			fnTemplate = os.path.join(tmpDir, 'template' + extension)
+			writeTemplate(fnTemplate)
+			templates = []
+			def templateLoad():
+				del templates[:]
+				templates.append(expensifier.ExpenseTemplate(fnTemplate))
+			timings[extension + ' templateLoad'] = \
+				describeTimes(timeFunction(templateLoad, options.repeats))
+
+			template = templates[0]
+			with Silenced():
+				sheets = [fullExpenseSheet(template) \
+					for i in range(options.sampleSheets)]
+			written = [0]
+			def sheet():
+				written[0] = 0
+				for xpen in sheets:
+					template.attachExpenseSheetCopy(xpen)
+					xpen.writeSheet(xpen.cellWriter)
+					f = StringIO.StringIO()
+					xpen.wb.save(f)
+					written[0] += len(f.getvalue())
+			name = extension + ' sheet'
+			timings[name] = describeTimes(timeFunction(sheet, options.repeats))
+			throughput[name + 's/s'] = round(len(sheets) * 1000.0 / \
+				max(timings[name]['median'], 0.01))
+			sizes[extension + ' bytes/sheet'] = written[0] / len(sheets)
+	finally:
+		shutil.rmtree(tmpDir)
+	return {'timings':timings, 'throughput':throughput, \
+		'sheets':options.sampleSheets, 'sizes':sizes}
+
+# Reading every amount in a synthetic dump of options.spec, with
+# locale.atof as it once was, and with expensifier's amountParser
+def benchAmounts(options):
+	spec = options.spec
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnDump = os.path.join(tmpDir, 'amounts.csv')
+		writeDump(fnDump, spec)
+		with open(fnDump, 'rb') as fDump:
+			amounts = [value for row in csv.DictReader(fDump) \
+				for value in (row['Amount'], row['Original Amount'])]
+	finally:
+		shutil.rmtree(tmpDir)
+
+	def atof():
+		previousLocale = locale.setlocale(locale.LC_ALL)
+		locale.setlocale(locale.LC_ALL, spec.locale)
+		try:
+			for amount in amounts:
+				locale.atof(amount)
+		finally:
+			locale.setlocale(locale.LC_ALL, previousLocale)
+	def parser():
+		parseAmount = expensifier.amountParser(spec.locale)
+		for amount in amounts:
+			parseAmount(amount)
+	timings = { \
+		'atof':describeTimes(timeFunction(atof, options.repeats)), \
+		'amountParser':describeTimes(timeFunction(parser, options.repeats)) \
+	}
+	throughput = dict((stage + ' amounts/s', round(len(amounts) * 1000.0 / \
+		max(times['median'], 0.01))) for (stage, times) in timings.iteritems())
+	return {'timings':timings, 'throughput':throughput, \
+		'parameters':spec.parameters(), 'rows':spec.rows}
+
+# Turning every timestamp in a synthetic dump of options.spec into a
+# date, with strptime as it once was, and with expensifier's
+# timestampDate, starting from an empty cache each time
+def benchDates(options):
+	spec = options.spec
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnDump = os.path.join(tmpDir, 'dates.csv')
+		writeDump(fnDump, spec)
+		with open(fnDump, 'rb') as fDump:
+			timestamps = [row['Timestamp'] for row in csv.DictReader(fDump)]
+	finally:
+		shutil.rmtree(tmpDir)
+
+	def strptime():
+		for timestamp in timestamps:
+			datetime.strptime(timestamp, expensifier.expensifyTimestampFormat). \
+				date()
+	def timestampDate():
+		expensifier.timestampDates.clear()
+		for timestamp in timestamps:
+			expensifier.timestampDate(timestamp)
+	timings = { \
+		'strptime':describeTimes(timeFunction(strptime, options.repeats)), \
+		'timestampDate':describeTimes(timeFunction(timestampDate, \
+			options.repeats)) \
+	}
+	perRowNs = dict((stage, round(times['median'] * 1e6 / len(timestamps))) \
+		for (stage, times) in timings.iteritems())
+	return {'timings':timings, 'perRowNs':perRowNs, \
+		'parameters':spec.parameters(), 'rows':spec.rows}
+
+# Splitting a company-wide export into a dump per employee and month: a
+# synthetic dump of options.spec, with each row given one of rows / 100
+# employees, split once with every row held in memory until the end, and
+# once with a tenth of them at a time, spilling the rest to disk
+def benchShard(options):
+	spec = options.spec
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnDump = os.path.join(tmpDir, 'dump.csv')
+		writeDump(fnDump, spec)
+		fnExport = os.path.join(tmpDir, 'export.csv')
+		employees = max(1, spec.rows / 100)
+		rng = random.Random(spec.seed)
+		with open(fnDump, 'rb') as fDump:
+			with open(fnExport, 'wb') as fExport:
+				writer = csv.writer(fExport)
+				for i, row in enumerate(csv.reader(fDump)):
+					writer.writerow(['Employee' if i == 0 else \
+						'Employee %d' % rng.randrange(employees)] + row)
+
+		# every run starts with no dumps, as a first run would
+		shards = []
+		def shard(bufferRows):
+			def run():
+				shards.append(len(expensifier.shardExport(fnExport, \
+					os.path.join(tmpDir, 'shards%d' % len(shards)), \
+					'Employee', 'month', bufferRows)))
+			return run
+		timings = { \
+			'inMemory':describeTimes(timeFunction(shard(spec.rows + 1), \
+				options.repeats)), \
+			'spilled':describeTimes(timeFunction(shard(max(1, spec.rows / 10)), \
+				options.repeats)) \
+		}
+	finally:
+		shutil.rmtree(tmpDir)
+	throughput = dict((stage + ' rows/s', round(spec.rows * 1000.0 / \
+		times['median'])) for (stage, times) in timings.iteritems())
+	return {'timings':timings, 'throughput':throughput, 'shards':shards[0], \
+		'parameters':spec.parameters(), 'rows':spec.rows}
+
+# Throw away what expensifier prints while it works
+class Silenced:
+	def __enter__(self):
+		self.stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'wb')
+	def __exit__(self, *exc):
+		sys.stdout.close()
+		sys.stdout = self.stdout
+		return False
+
+# Each stage of a conversion, on a synthetic dump of options.spec.
+# The reading stages stream the whole dump, and are timed as the
+# difference between passes that stop after each one:
+#   parse	csv.DictReader
+#   convert	ExpensifyFormatV1.convertExpense (and checkCurrency)
+#   combine	packing the expenses into ExpenseV3 sheets
+# The per-sheet stages are timed on up to options.sampleSheets of the
+# sheets that come out:
+#   templateCopy	xlutils copy of the blank form, as each sheet once had
+#   formulas		recreating the formulas on that copy
+#   templateClone	unpickling the compiled template, as each sheet now has
+#   cellWrite		filling in the cells
+#   save		wb.save, to memory
+def benchStages(options):
+	spec = options.spec
+	e = expensifier
+	config = e.ReportConfig('Benchmark', spec.homeCurrency(), 2.5, spec.locale)
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnDump = os.path.join(tmpDir, 'stages.csv')
+		writeDump(fnDump, spec)
+		fnTemplate = options.fnTemplate
+		if fnTemplate == None:
+			fnTemplate = os.path.join(tmpDir, 'template.xls')
+			writeTemplate(fnTemplate)
+
+		def parse():
+			with open(fnDump, 'rb') as fDump:
+				for row in csv.DictReader(fDump):
+					pass
+		def convert():
+			with open(fnDump, 'rb') as fDump:
+				wrapper = e.ExpensifyFormatV1()
+				wrapper.setAmountLocale(spec.locale)
+				wrapper.initExpensifyDump(fDump)
+				for exp in wrapper.getCheckedExpenses(config.homeCurrency):
+					pass
+		sheets = []
+		def combine():
+			del sheets[:]
+			for xpen in e.packExpenses( \
+					e.readExpensifyDump(fnDump, config), config, 'stages'):
+				if len(sheets) < options.sampleSheets:
+					sheets.append(xpen)
+
+		with Silenced():
+			parseTimes = timeFunction(parse, options.repeats)
+			convertTimes = timeFunction(convert, options.repeats)
+			combineTimes = timeFunction(combine, options.repeats)
+			sheetCount = len(list(e.packExpenses( \
+				e.readExpensifyDump(fnDump, config), config, 'stages')))
+
+			e.loadSpreadsheetModules()
+			rb = e.xlrd.open_workbook(fnTemplate, formatting_info = True)
+			template = e.ExpenseTemplate(fnTemplate)
+			for xpen in sheets:
+				xpen.addCurrencyCostExpense()
+
+			copies = []
+			def templateCopy():
+				del copies[:]
+				for xpen in sheets:
+					copies.append(e.copy(rb))
+			def formulas():
+				for wb in copies:
+					e.ExpenseV3(wb, wb.get_sheet(0), None, None). \
+						recreateFormulas(e.formulaWriter)
+			def templateClone():
+				for xpen in sheets:
+					template.attachExpenseSheetCopy(xpen)
+			def cellWrite():
+				for xpen in sheets:
+					xpen.writeSheet(e.writer)
+			written = [0]
+			def save():
+				written[0] = 0
+				for xpen in sheets:
+					f = StringIO.StringIO()
+					xpen.wb.save(f)
+					written[0] += len(f.getvalue())
+
+			sheetTimes = {}
+			for stage in [templateCopy, formulas, templateClone, cellWrite, \
+					save]:
+				sheetTimes[stage.__name__] = timeFunction(stage, options.repeats)
+	finally:
+		shutil.rmtree(tmpDir)
+
+	def difference(after, before):
+		return [a - b for (a, b) in zip(after, before)]
+	timings = { \
+		'parse':describeTimes(parseTimes), \
+		'convert':describeTimes(difference(convertTimes, parseTimes)), \
+		'combine':describeTimes(difference(combineTimes, convertTimes)) \
+	}
+	throughput = {}
+	for stage in ['parse', 'convert', 'combine']:
+		throughput[stage + ' rows/s'] = \
+			round(spec.rows * 1000.0 / max(timings[stage]['median'], 0.01))
+	for stage, times in sheetTimes.iteritems():
+		timings[stage] = describeTimes(times)
+		throughput[stage + ' sheets/s'] = \
+			round(len(sheets) * 1000.0 / max(timings[stage]['median'], 0.01))
+	return {'timings':timings, 'throughput':throughput, \
+		'parameters':spec.parameters(), \
+		'rows':spec.rows, 'sheets':sheetCount, 'sampledSheets':len(sheets), \
+		'bytesPerSheet':written[0] / max(len(sheets), 1), \
+		# ru_maxrss is in kB on Linux
+		'peakRssKb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+# What each expense of a synthetic dump costs to hold in memory, as
+# Expense objects and once packed into ExpenseV3 sheets, next to the
+# old LegacyExpense. Sizes are deepSize, so they don't vary from run to
+# run; timings are for reading the dump into a list of each.
+def benchMemory(options):
+	spec = options.spec
+	e = expensifier
+	config = e.ReportConfig('Benchmark', spec.homeCurrency(), 2.5, spec.locale)
+	tmpDir = tempfile.mkdtemp()
+	try:
+		fnDump = os.path.join(tmpDir, 'memory.csv')
+		writeDump(fnDump, spec)
+
+		expenses = []
+		def current():
+			del expenses[:]
+			expenses.extend(e.readExpensifyDump(fnDump, config))
+		legacyExpenses = []
+		def legacy():
+			del legacyExpenses[:]
+			# as readExpensifyDump used to, for locale.atof
+			previousLocale = locale.setlocale(locale.LC_ALL)
+			locale.setlocale(locale.LC_ALL, spec.locale)
+			try:
+				with open(fnDump, 'rb') as fDump:
+					for row in csv.DictReader(fDump):
+						legacyExpenses.append(LegacyExpense( \
+							e.ExpensifyFormatV1.mapExpensifyFieldToExpenseType[ \
+								row['Category']], \
+							datetime.strptime(row['Timestamp'], \
+								"%Y-%m-%d %H:%M:%S").date(), \
+							row['Comment'], locale.atof(row['Amount']), \
+							row['Merchant'], row['Original Currency'], \
+							locale.atof(row['Original Amount'])))
+			finally:
+				locale.setlocale(locale.LC_ALL, previousLocale)
+
+		with Silenced():
+			timings = { \
+				'readExpenses':describeTimes(timeFunction(current, \
+					options.repeats)), \
+				'readLegacyExpenses':describeTimes(timeFunction(legacy, \
+					options.repeats)) \
+			}
+			sheets = list(e.packExpenses(expenses, config, 'memory', \
+				e.ConvertOptions(packing = 'optimal')))
+	finally:
+		shutil.rmtree(tmpDir)
+
+	rows = max(spec.rows, 1)
+	return {'timings':timings, 'parameters':spec.parameters(), \
+		'rows':spec.rows, 'sheets':len(sheets), \
+		'memory':{ \
+			'bytesPerExpense':deepSize(expenses) / rows, \
+			'bytesPerLegacyExpense':deepSize(legacyExpenses) / rows, \
+			'bytesPerPackedExpense':deepSize(sheets) / rows \
+		}, \
+		'peakRssKb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+# (function, default repeats)
+benchmarks = { \
+	'startup':(benchStartup, 10), \
+	'cellwrite':(benchCellWrite, 10), \
+	'stages':(benchStages, 3), \
+	'memory':(benchMemory, 1), \
+	'formats':(benchFormats, 5), \
+	'amounts':(benchAmounts, 5), \
+	'dates':(benchDates, 3), \
+	'shard':(benchShard, 3) \
+}
+
+# Everything a benchmark might need to know about how to run
+class BenchOptions:
+	def __init__(self, repeats, spec = None, fnTemplate = None, \
+			sampleSheets = 200):
+		self.repeats = repeats
+		self.spec = spec
+		self.fnTemplate = fnTemplate
+		self.sampleSheets = sampleSheets
+
+def loadResults(fnResults):
+	results = []
+	if os.path.exists(fnResults):
+		with open(fnResults, 'rb') as fResults:
+			for line in fResults:
+				if line.strip():
+					results.append(json.loads(line))
+	return results
+
+def saveResult(fnResults, result):
+	with open(fnResults, 'ab') as fResults:
+		fResults.write(json.dumps(result, sort_keys = True) + '\n')
+
+# Compare every median, and every memory size, in result against the
+# last saved result for the same benchmark. Returns a list of
+# descriptions of what got slower or bigger.
+def compareResult(previous, result, tolerance):
+	regressions = []
+	for name, times in result['timings'].iteritems():
+		if name not in previous['timings']:
+			continue
+		before = previous['timings'][name]['median']
+		after = times['median']
+		if after > before * (1.0 + tolerance):
+			regressions.append('%s: median %.2fms, was %.2fms' % \
+				(name, after, before))
+	for name, after in result.get('memory', {}).iteritems():
+		before = previous.get('memory', {}).get(name)
+		if before != None and after > before * (1.0 + tolerance):
+			regressions.append('%s: %d bytes, was %d' % (name, after, before))
+	return regressions
+
+usage = sys.argv[0] + """ [-n <repeats>] [-s <results>] [-c <results>] [-t <tolerance>]
+	[dump options] [--template <input_sheet>] <benchmark>
+       """ + sys.argv[0] + """ [dump options] generate <expensify_dump>
+
+dump options: [-r <rows>] [-l <locale>] [--categories <mix>]
+	[--currencies <mix>] [--days <days>] [--seed <seed>]
+
+repeats:	How many times to run each timing. Default is 10 (3 for stages,
+		dates and shard, 5 for formats and amounts, 1 for memory).
+results:	File of saved results. -s appends this run to it, -c compares
+		this run to the last one saved there for the same benchmark
+		and dump options.
+tolerance:	Fraction a median or size may grow by before -c fails.
+		Default is 0.2.
+input_sheet:	Blank expense form for stages. Default is a one-cell stand-in.
+benchmark:	One of """ + ', '.join(sorted(benchmarks.keys())) + """
+rows:		Rows in the synthetic dump, e.g. 1000 to 10000000. Default 100000.
+locale:		Locale the amounts are written in. Default is C.
+mix:		"name=weight,..." e.g. "Lodging=2,Transport - Taxi". Categories
+		are Expensify's (see expensifier.py -h). The first currency is
+		the home currency. Default is every Expensify category evenly,
+		and "USD=8,EUR=1,GBP=1".
+days:		How many days the expenses are spread over. Default is 365.
+seed:		Random seed. The same options always make the same dump."""
+
+def main(argv):
+	try:
+		opts, args = getopt.getopt(argv[1:], "hn:s:c:t:r:l:", \
+			["template=", "categories=", "currencies=", "days=", "seed="])
+	except getopt.GetoptError:
+		print usage
+		sys.exit(2)
+
+	repeats = None
+	fnSave = None
+	fnCompare = None
+	tolerance = 0.2
+	fnTemplate = None
+	spec = DumpSpec()
+	for opt, arg in opts:
+		if opt == '-h':
+			print usage
+			sys.exit()
+		elif opt == '-n':
+			repeats = int(arg)
+		elif opt == '-s':
+			fnSave = arg
+		elif opt == '-c':
+			fnCompare = arg
+		elif opt == '-t':
+			tolerance = float(arg)
+		elif opt == '-r':
+			spec.rows = int(arg)
+		elif opt == '-l':
+			spec.locale = arg
+		elif opt == '--categories':
+			try:
+				spec.setCategories(parseMix(arg))
+			except ValueError as ex:
+				print str(ex)
+				print usage
+				sys.exit(2)
+		elif opt == '--currencies':
+			spec.currencies = parseMix(arg)
+		elif opt == '--days':
+			spec.days = int(arg)
+		elif opt == '--seed':
+			spec.seed = int(arg)
+		elif opt == '--template':
+			fnTemplate = arg
+
+	if len(args) == 2 and args[0] == 'generate':
+		writeDump(args[1], spec)
+		sys.exit()
+	if len(args) != 1 or args[0] not in benchmarks:
+		print usage
+		sys.exit(2)
+
+	name = args[0]
+	bench, defaultRepeats = benchmarks[name]
+	if repeats == None:
+		repeats = defaultRepeats
+	result = bench(BenchOptions(repeats, spec, fnTemplate))
+	result.update({'benchmark':name, 'when':datetime.now().isoformat(), \
+		'python':sys.version.split()[0]})
+	for timing, times in sorted(result['timings'].iteritems()):
+		print '%-24s min %10.2f  median %10.2f  max %10.2f' % \
+			(timing, times['min'], times['median'], times['max'])
+	for stat, value in sorted(result.get('throughput', {}).iteritems()):
+		print '%-24s %12d' % (stat, value)
+	for stat, value in sorted(result.get('memory', {}).iteritems()):
+		print '%-24s %12d' % (stat, value)
+	for stat, value in sorted(result.get('sizes', {}).iteritems()):
+		print '%-24s %12d' % (stat, value)
+	for stat, value in sorted(result.get('perRowNs', {}).iteritems()):
+		print '%-24s %12d ns/row' % (stat, value)
+	for stat in ['rows', 'sheets', 'sampledSheets', 'bytesPerSheet', \
+			'peakRssKb', 'shards']:
+		if stat in result:
+			print '%-24s %12d' % (stat, result[stat])
+
+	regressions = []
+	if fnCompare != None:
+		previous = [r for r in loadResults(fnCompare) \
+			if r['benchmark'] == name and \
+			r.get('parameters') == result.get('parameters')]
+		if len(previous) > 0:
+			regressions = compareResult(previous[-1], result, tolerance)
+	if fnSave != None:
+		saveResult(fnSave, result)
+	if len(regressions) > 0:
+		print 'REGRESSIONS:'
+		for regression in regressions:
+			print '  ' + regression
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main(sys.argv)
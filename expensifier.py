@@ -1,43 +1,86 @@
 #!/usr/bin/python
-import sys, getopt, csv, xlrd, xlwt, locale, os
-from xlutils.copy import copy
+import sys, getopt, csv, locale, os, mmap, re
+import collections, cPickle, cStringIO, hashlib, heapq, itertools, operator, time
+import thread
 from datetime import datetime, date
 
 # A couple of constants. Should probably parameterise these at some point.
 BUSINESSPURPOSE = "Sales"
 DEPARTMENT = 'Sales'
 
-# Styles for numbers, text written into the spreadsheet
-currencyStyle = xlwt.easyxf("font: color black, bold 1", "#,###.00")
-textStyle = xlwt.easyxf("font: color blue")
+# Nothing slow happens at import time, so that -h and dry runs start
+# quickly: see benchmark.py startup. Modules only some runs need
+# (multiprocessing, sqlite3, json, numpy) are imported where they're used.
+#
+# xlrd, xlwt and xlutils are only needed once a sheet is actually
+# written, and a dry run never writes one, so they aren't imported until
+# loadSpreadsheetModules() is called. Same for the styles for numbers,
+# text written into the spreadsheet.
+xlrd = None
+xlwt = None
+copy = None
+currencyStyle = None
+textStyle = None
+
+def loadSpreadsheetModules():
+	global xlrd, xlwt, copy, currencyStyle, textStyle
+	if xlwt != None:
+		return
+	import xlrd, xlwt
+	from xlutils.copy import copy
+	currencyStyle = xlwt.easyxf("font: color black, bold 1", "#,###.00")
+	textStyle = xlwt.easyxf("font: color blue")
 
 class InvalidVersion(Exception):
 	def __init__(self, value):
+		# passed on so that it survives pickling, e.g. from a pool worker
+		Exception.__init__(self, value)
 		self.value = value
 	def __str__(self):
 		return repr(self.value)
 
 class OverflowException(Exception):
 	def __init__(self, value):
+		Exception.__init__(self, value)
 		self.value = value
 	def __str__(self):
 		return repr(self.value)
 
 class InvalidCSVCurrency(Exception):
 	def __init__(self, value):
+		Exception.__init__(self, value)
 		self.value = value
 	def __str__(self):
 		return repr(self.value)
 
+class InvalidLayout(Exception):
+	def __init__(self, value):
+		Exception.__init__(self, value)
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+# Strings that repeat across a dump (merchants, currencies) are kept
+# once, however many expenses mention them
+def internValue(value):
+	if type(value) is str:
+		return intern(value)
+	return value
+
 # base class: Expenses always have to have dates, merchant, etc
-class Expense:
+# There can be millions of these, so they have __slots__ rather than a
+# __dict__ each: see benchmark.py memory.
+class Expense(object):
+	__slots__ = ('expenseType', 'date', 'description', 'amount', \
+		'merchant', 'origCurrency', 'origAmount')
+
 	def __init__(self, expenseType, date, description, amount, merchant, origCurrency, origAmount):
 		self.expenseType = expenseType
 		self.date = date
 		self.description = description
 		self.amount = float(amount)
-		self.merchant = merchant
-		self.origCurrency = origCurrency
+		self.merchant = internValue(merchant)
+		self.origCurrency = internValue(origCurrency)
 		self.origAmount = float(origAmount)
 
 	def __repr__(self):
@@ -47,103 +90,54 @@ class Expense:
 			self.description + "\"; amount: " + \
 			str(self.amount) + "; origCurrency: " + \
 			self.origCurrency + "; origAmount: " + \
-			self.origAmount + ")"
-
-def char_range(c1, c2):
-	"""Generates the characters from `c1` to `c2`, inclusive."""
-	for c in xrange(ord(c1), ord(c2)+1):
-		yield chr(c)
+			str(self.origAmount) + ")"
 
 # hide all the details of the current expense report format here so
-# it can be changed more easily if the format changes in the future
+# it can be changed more easily if the format changes in the future.
+# Where everything goes on the form comes from a ReportLayout (see
+# layouts/), by default the V3 one; packing only needs to know how many
+# rows each section has.
 class ExpenseV3:
-	v3SheetName = "Expense Report Revised V3"
-	mapExpenseTypeToColumnLetter = { \
-		'breakfast':'C', \
-		'lunch':'D', \
-		'dinner':'E', \
-		'hotel':'G', \
-		'air':'H', \
-		'rail':'I', \
-		'carRental':'J', \
-		'taxi':'K', \
-		'parkingToll':'L', \
-		'phone':'M', \
-		'other':'N' \
-	}
-
-	mapMandatoryFillToAddr = { \
-			'businessPurposeAddr':'H1', \
-			'nameAddr':'L1', \
-			'departmentAddr':'N2', \
-			'periodCoveredAddr':'N3'
-	}
-
-	travelExpensesRowStart = 6
-	travelExpensesMax = 8
-	entertainmentExpensesRowStart = 18
-	entertainmentExpensesMax = 8
-	miscellaneousExpensesRowStart = 30
-	miscellaneousExpensesMax = 11
-
-	# writer must be a function that works on the already-provided sheet st
+	# writer must be a function that works on the already-provided sheet st,
+	# taking a list of (row, col, value, style) cells to write
 	def recreateFormulas(self, writer):
-		for i in range(6, 14):
-			writer(self.st, 'P' + str(i), 'SUM(G%d:O%d)' % (i, i))
-			writer(self.st, 'F' + str(i), 'SUM(C%d:E%d)' % (i, i))
-		for i in char_range('F', 'P'):
-			writer(self.st, i + '14', 'SUM(%s6:%s13)' % (i, i))
-		writer(self.st, 'P26', 'SUM(P18:P25)')
-		for col in 'H', 'L', 'O':
-			writer(self.st, col + '41', 'SUM(%s30:%s40)' % (col, col))
-		for i in range(30, 35):
-			writer(self.st, 'L' + str(i), chr(ord('F')+i-30) + '14')
-		writer(self.st, 'L35', 'K14+L14')
-		writer(self.st, 'L36', 'M14')
-		writer(self.st, 'L37', 'N14+O14')
-		writer(self.st, 'L38', 'P26')
-		writer(self.st, 'L39', 'P52')
-		writer(self.st, 'L40', 'H41')
-		for i in range(30, 41):
-			writer(self.st, 'O' + str(i), 'L' + str(i) + '*N' + str(i))
-		writer(self.st, 'C44', 'L41')
-
-	def writeTravelExp(self, writer, rowIndex, date, desc, expenseMap):
-		row = self.travelExpensesRowStart + rowIndex
-		writer(self.st, 'A' + str(row), str(date))
-		writer(self.st, 'B' + str(row), str(desc))
-		for category, column in self.mapExpenseTypeToColumnLetter.iteritems():
+		writer(self.st, self.layout.formulaCells)
+
+	# The write methods below add cells to a batch, for writing in one go.
+	# Each row of a section is its row and (col, value, currency) columns,
+	# value being a function of the entry written there.
+	def writeSectionRow(self, cells, sectionRow, exp):
+		row, columns = sectionRow
+		for col, value, currency in columns:
+			if currency:
+				cells.append((row, col, value(exp), currencyStyle))
+			else:
+				cells.append((row, col, value(exp), textStyle))
+
+	def writeTravelExp(self, cells, rowIndex, exp):
+		sectionRow = self.layout.travel.cells[rowIndex]
+		self.writeSectionRow(cells, sectionRow, exp)
+		row = sectionRow[0]
+		expenseMap = exp.expenseMap
+		for category, col in self.layout.travel.categoryColumns:
 			if category in expenseMap:
-				writer(self.st, column + str(row), \
-				expenseMap[category], \
-				currencyStyle)
-
-	def writeEntertainmentExp(self, writer, rowIndex, date, desc, amount, merchant):
-		row = self.entertainmentExpensesRowStart + rowIndex
-		writer(self.st, 'A' + str(row), str(date))
-		writer(self.st, 'B' + str(row), BUSINESSPURPOSE)
-		writer(self.st, 'D' + str(row), str(desc))
-		writer(self.st, 'J' + str(row), str(merchant))
-		writer(self.st, 'P' + str(row), amount, currencyStyle)
-		
-	def writeMiscellaneousExp(self, writer, rowIndex, date, desc, amount, merchant):
-		row = self.miscellaneousExpensesRowStart + rowIndex
-		writer(self.st, 'A' + str(row), str(date))
-		writer(self.st, 'B' + str(row), str(merchant) + ': ' + str(desc))
-		writer(self.st, 'F' + str(row), DEPARTMENT)
-		writer(self.st, 'H' + str(row), amount, currencyStyle)
-
-	def writeMandatoryData(self, writer, currency, name, lowDate, highDate):
-		writer(self.st, 'O29', currency)
-		writer(self.st, 'B44', 'TOTAL EXPENSE ' + currency)
-		writer(self.st, 'E44', 'Not Applicable - Reimbursement in ' + currency)
-		writer(self.st, 'G44', 'Not Applicable - Reimbursement in ' + currency)
-		writer(self.st, 'H1', BUSINESSPURPOSE)
-		writer(self.st, 'M1', name)
-		writer(self.st, 'N2', DEPARTMENT)
+				cells.append((row, col, expenseMap[category], currencyStyle))
+
+	def writeMandatoryData(self, cells, currency, name, lowDate, highDate):
+		values = { \
+			'currency':currency, \
+			'name':name, \
+			'businessPurpose':BUSINESSPURPOSE, \
+			'department':DEPARTMENT, \
+			'periodCovered':None, \
+			'today':str(date.today()) \
+		}
 		if lowDate != None and highDate != None:
-			writer(self.st, 'N3', str(lowDate) + ' to ' + str(highDate))
-		writer(self.st, 'E48', str(date.today()))
+			values['periodCovered'] = str(lowDate) + ' to ' + str(highDate)
+		for row, col, text, names in self.layout.fieldCells:
+			# a field with nothing to fill it in with is left blank
+			if None not in [values[name] for name in names]:
+				cells.append((row, col, text % values, textStyle))
 
 	def __sanityCheck(self):
 		# should fill this in at some point!
@@ -155,12 +149,26 @@ class ExpenseV3:
 	# We want to create an expense accumulator, that keeps entries based on date and
 	# limits the number of expenses allowed
 	class AccumulatedDailyExpenseSet:
-		class DailyExpenseAccumulator:
+		# The descriptions of a day's expenses are only joined up when
+		# the description is asked for, rather than copied into a longer
+		# string every time another expense is added
+		class DailyExpenseAccumulator(object):
+			__slots__ = ('date', 'descriptions', 'expenseMap')
+
 			def __init__(self, date, description, expenseMap):
 				self.date = date
-				self.description = description
+				self.descriptions = []
+				if len(description) > 0:
+					self.descriptions.append(description)
 				self.expenseMap = expenseMap
 
+			@property
+			def description(self):
+				return ' / '.join(self.descriptions)
+
+			def addDescription(self, description):
+				self.descriptions.append(description)
+
 			def __repr__(self):
 				return "<<" + str(self.date) + "," + \
 					self.description + "," + \
@@ -186,11 +194,9 @@ class ExpenseV3:
 
 				# add the description
 				if len(expense.description) > 0:
-					if len(accum.description) > 0:
-						accum.description += ' / '
-					accum.description += \
+					accum.addDescription( \
 						self.__formDescription(expense.merchant, \
-						expense.description)
+						expense.description))
 
 				# now add in the amount to the correct keyed entry
 				expenseMap = accum.expenseMap
@@ -253,10 +259,11 @@ class ExpenseV3:
 	def addCurrencyCost(self, exp):
 		# if the credit card charges a currency conversion
 		# charge (and most do), then add it in here.
-		if currencyUpliftPerc > 0.0 and \
+		homeCurrency = self.config.homeCurrency
+		if self.config.currencyUpliftPerc > 0.0 and \
 			homeCurrency != exp.origCurrency:
 			currencyCostAdjustment = round(exp.amount * \
-				currencyUpliftPerc, 2)
+				self.config.currencyUpliftPerc, 2)
 			self.currencyCost += currencyCostAdjustment
 			print "Adding %s%.2f of currency cost to " \
 				"amount %s%.2f (orig %s) " \
@@ -305,18 +312,18 @@ class ExpenseV3:
 		else:
 			self.combineTravelExp(exp)
 
-	def save(self):
-		assert not self.isEmpty()
-
-		# Insert the currency cost
+	# Insert the currency cost. Done once, when the sheet is complete,
+	# before it's saved or summarized.
+	def addCurrencyCostExpense(self):
 		assert self.anyDate != None
+		homeCurrency = self.config.homeCurrency
 		try:
 			if self.currencyCost > 0.0:
 				explanation = "%s%.2f in total currency conversion charges" % \
 					(homeCurrency, self.currencyCost)
 				currExp = Expense('other', self.anyDate, explanation, \
 					self.currencyCost, "CC", homeCurrency, self.currencyCost)
-				xpen.travelExp.combine(currExp)
+				self.travelExp.combine(currExp)
 				print explanation
 		except OverflowException:
 			# anyDate should be set to (i) any date in the accumulator set,
@@ -338,60 +345,187 @@ class ExpenseV3:
 		except:
 			raise
 
-		# Now write everything into the Excel spreadsheet
-		rowIndex = 0
-		for exp in self.travelExp.getAccumulators():
-			self.writeTravelExp(writer, rowIndex, exp.date, \
-					exp.description, exp.expenseMap)
-			rowIndex += 1
-		rowIndex = 0
-		for exp in self.entertainmentExp.getValues():
+	# Now write everything into the Excel spreadsheet, as one batch
+	def writeSheet(self, writer):
+		cells = []
+		for rowIndex, exp in enumerate(self.travelExp.getAccumulators()):
+			self.writeTravelExp(cells, rowIndex, exp)
+		sectionCells = self.layout.entertainment.cells
+		for rowIndex, exp in enumerate(self.entertainmentExp.getValues()):
 			if len(exp.description) == 0:
 				print "WARNING: Entertainment expenses MUST have descriptions"
-			self.writeEntertainmentExp(writer, rowIndex, exp.date, \
-				exp.description, exp.amount, exp.merchant)
-			rowIndex += 1
-		rowIndex = 0
-		for exp in self.miscellaneousExp.getValues():
+			self.writeSectionRow(cells, sectionCells[rowIndex], exp)
+		sectionCells = self.layout.miscellaneous.cells
+		for rowIndex, exp in enumerate(self.miscellaneousExp.getValues()):
 			if len(exp.description) == 0:
 				print "WARNING: Miscellaneous expenses MUST have descriptions"
-			self.writeMiscellaneousExp(writer, rowIndex, exp.date, \
-				exp.description, exp.amount, exp.merchant)
-			rowIndex += 1
+			self.writeSectionRow(cells, sectionCells[rowIndex], exp)
 
-		self.writeMandatoryData(writer, homeCurrency, yourName, \
-			self.low, self.high)
+		self.writeMandatoryData(cells, self.config.homeCurrency, \
+			self.config.yourName, self.low, self.high)
+		writer(self.st, cells)
+
+	# Save to fnOutputSpreadsheet, or if given a stream (anything with a
+	# write method), write the workbook to that instead
+	def save(self, stream = None):
+		assert not self.isEmpty()
+		self.addCurrencyCostExpense()
+
+		with profiler.timed('writeSheet'):
+			self.writeSheet(self.cellWriter)
 
 		# Save the workbook
-		print "Saving to " + self.fnOutputSpreadsheet
-		self.wb.save(self.fnOutputSpreadsheet)
+		target = stream
+		if stream == None:
+			print "Saving to " + self.fnOutputSpreadsheet
+			target = self.fnOutputSpreadsheet
+		with profiler.timed('workbookSave'):
+			self.wb.save(target)
+		profiler.count('sheetsSaved')
+		if profiler.enabled and stream == None:
+			profiler.count('bytesWritten', \
+				os.path.getsize(self.fnOutputSpreadsheet))
+
+	# save(), but handing back the .xls file's bytes rather than
+	# putting them anywhere
+	def saveBytes(self):
+		stream = cStringIO.StringIO()
+		self.save(stream)
+		data = stream.getvalue()
+		profiler.count('bytesWritten', len(data))
+		return data
+
+	# What save() would have put on the sheet, for dry runs
+	def summarize(self):
+		assert not self.isEmpty()
+		self.addCurrencyCostExpense()
 
-	def __init__(self, wb, st, fnOutputSpreadsheet):
+		travel = {}
+		for exp in self.travelExp.getAccumulators():
+			for category, amount in exp.expenseMap.iteritems():
+				travel[category] = travel.get(category, 0.0) + amount
+		entertainment = sum(exp.amount \
+			for exp in self.entertainmentExp.getValues())
+		miscellaneous = sum(exp.amount \
+			for exp in self.miscellaneousExp.getValues())
+		return { \
+			'sheet':self.fnOutputSpreadsheet, \
+			'low':str(self.low), \
+			'high':str(self.high), \
+			'travel':dict((category, round(amount, 2)) \
+				for (category, amount) in travel.iteritems()), \
+			'travelDays':len(self.travelExp), \
+			'entertainment':round(entertainment, 2), \
+			'entertainmentEntries':len(self.entertainmentExp), \
+			'miscellaneous':round(miscellaneous, 2), \
+			'miscellaneousEntries':len(self.miscellaneousExp), \
+			'currencyCost':round(self.currencyCost, 2), \
+			'total':round(sum(travel.values()) + entertainment + \
+				miscellaneous, 2) \
+		}
+
+	# wb and st can be None while expenses are being packed; they must be
+	# filled in with a copy of the form before save(). layout is the
+	# ReportLayout of the form the sheet will be a copy of.
+	def __init__(self, wb, st, fnOutputSpreadsheet, config, layout = None):
 		try:
+			if layout == None:
+				layout = reportLayout(defaultLayoutName)
+			self.layout = layout
+			self.config = config
 			self.anyDate = None
 			self.low = None
 			self.high = None
 			self.wb = wb
 			self.st = st
+			self.cellWriter = writer
 			self.fnOutputSpreadsheet = fnOutputSpreadsheet
 			self.currencyCost = 0.0
 
 			self.travelExp = \
-				self.AccumulatedDailyExpenseSet(self.travelExpensesMax)
+				self.AccumulatedDailyExpenseSet(layout.travel.rows)
 			assert len(self.travelExp) == 0
 
 			self.entertainmentExp = \
-				self.FixedExpenseSet(self.entertainmentExpensesMax)
+				self.FixedExpenseSet(layout.entertainment.rows)
 			assert len(self.entertainmentExp) == 0
 
 			self.miscellaneousExp = \
-				self.FixedExpenseSet(self.miscellaneousExpensesMax)
+				self.FixedExpenseSet(layout.miscellaneous.rows)
 			assert len(self.miscellaneousExp) == 0
 		except:
 #			raise InvalidVersion("No V3 worksheet available")
 			raise
 		self.__sanityCheck()
 
+# Module-level names for the nested classes, so that packed ExpenseV3
+# sheets can be pickled across to worker processes
+AccumulatedDailyExpenseSet = ExpenseV3.AccumulatedDailyExpenseSet
+DailyExpenseAccumulator = AccumulatedDailyExpenseSet.DailyExpenseAccumulator
+FixedExpenseSet = ExpenseV3.FixedExpenseSet
+
+# The thousands separator and decimal point of a locale, looked up once.
+# localeconv() only reports on the process's current locale, so it is
+# switched to localeName for the lookup and straight back, under a lock;
+# nothing here depends on the current locale otherwise, so dumps in
+# different locales can be read at the same time.
+numericConventionsCache = {}
+numericConventionsLock = thread.allocate_lock()
+
+def numericConventions(localeName):
+	if localeName not in numericConventionsCache:
+		with numericConventionsLock:
+			# another thread may have looked it up while we waited
+			if localeName not in numericConventionsCache:
+				previous = locale.setlocale(locale.LC_NUMERIC)
+				try:
+					locale.setlocale(locale.LC_NUMERIC, localeName)
+					conv = locale.localeconv()
+				finally:
+					locale.setlocale(locale.LC_NUMERIC, previous)
+				numericConventionsCache[localeName] = \
+					(conv['thousands_sep'], conv['decimal_point'])
+	return numericConventionsCache[localeName]
+
+# locale.atof for one locale, without going through the current locale:
+# the separators are baked in, rather than fetched with two localeconv()
+# calls per amount, which is most of what locale.atof costs
+def amountParser(localeName):
+	thousandsSep, decimalPoint = numericConventions(localeName)
+	if thousandsSep == '' and decimalPoint in ('', '.'):
+		return float
+	def parseAmount(amount):
+		if thousandsSep != '':
+			amount = amount.replace(thousandsSep, '')
+		if decimalPoint != '':
+			amount = amount.replace(decimalPoint, '.')
+		return float(amount)
+	return parseAmount
+
+# The date of an Expensify timestamp, "%Y-%m-%d %H:%M:%S". strptime is
+# slow, and all we keep is the date, which a big dump repeats for every
+# expense that day; so a timestamp in exactly that fixed-width form gets
+# its date from a cache keyed by the "%Y-%m-%d" part. Anything else, and
+# the first timestamp of each day, still goes through strptime, so what
+# is accepted and what raises is unchanged.
+expensifyTimestampFormat = "%Y-%m-%d %H:%M:%S"
+fixedTimestampRe = re.compile( \
+	r'\d{4}-\d\d-\d\d (?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d\Z')
+timestampDates = {}
+timestampDatesMax = 1 << 16
+
+def timestampDate(timestamp):
+	if fixedTimestampRe.match(timestamp) != None:
+		day = timestampDates.get(timestamp[:10])
+		if day != None:
+			return day
+		day = datetime.strptime(timestamp, expensifyTimestampFormat).date()
+		if len(timestampDates) >= timestampDatesMax:
+			timestampDates.clear()
+		timestampDates[timestamp[:10]] = day
+		return day
+	return datetime.strptime(timestamp, expensifyTimestampFormat).date()
+
 # hide all the details of the Expensify expense report format here so
 # it can be changed more easily if the format changes in the future
 class ExpensifyFormatV1:
@@ -413,21 +547,38 @@ class ExpensifyFormatV1:
 			'Transport - Toll':'parkingToll' \
 	}
 
+	# If set, called as rowFilter(fieldnames, row) for every row before
+	# it is converted; rows it returns False for are skipped
+	rowFilter = None
+
+	# Amounts are read in the current locale unless setAmountLocale() is
+	# called; atof is replaced by a timed one while profiling
+	amountLocale = None
+	atof = staticmethod(locale.atof)
+
+	def setAmountLocale(self, localeName):
+		self.amountLocale = localeName
+		self.atof = amountParser(localeName)
+
+	# what convertExpense reads from each row
+	requiredFields = ['Category', 'Timestamp', 'Comment', 'Amount', \
+		'Merchant', 'Original Currency', 'Original Amount']
+
 	def initExpensifyDump(self, f):
 		self.rdr = csv.DictReader(f)
 
 	def convertExpense(self, exp):
 		try:
 			category = exp['Category']
-			date = datetime.strptime(exp['Timestamp'], "%Y-%m-%d %H:%M:%S").date()
+			date = timestampDate(exp['Timestamp'])
 			description = exp['Comment']
-			amount = locale.atof(exp['Amount']) # the locale conversion!
+			amount = self.atof(exp['Amount']) # the locale conversion!
 			merchant = exp['Merchant']
 			origCurrency = exp['Original Currency']
 			# We should really have an 'original locale' field, but
 			# this is only used for an assertion later, so this will
 			# suffice
-			origAmount = locale.atof(exp['Original Amount'])
+			origAmount = self.atof(exp['Original Amount'])
 			try:
 				expenseType = self.mapExpensifyFieldToExpenseType[category]
 			except:
@@ -442,12 +593,395 @@ class ExpensifyFormatV1:
 		except Exception as ex:
 			raise InvalidVersion('Cannot locate fields in Expensify dump:' + str(ex))
 
+	# Everything wrong with a row, as (field, message) pairs, where
+	# convertExpense and checkCurrency stop at the first thing. Rows
+	# that convert are only checked once, so this is no slower for them.
+	def validateExpense(self, exp, homeCurrency):
+		try:
+			checkCurrency(self.convertExpense(exp), homeCurrency)
+			return []
+		except InvalidCSVCurrency as ex:
+			return [('Original Amount', ex.value)]
+		except InvalidVersion:
+			pass
+
+		errors = []
+		for field in self.requiredFields:
+			if exp.get(field) == None:
+				errors.append((field, 'missing'))
+		category = exp.get('Category')
+		if category != None and \
+				category not in self.mapExpensifyFieldToExpenseType:
+			errors.append(('Category', 'unknown category "%s"' % category))
+		if exp.get('Timestamp') != None:
+			try:
+				datetime.strptime(exp['Timestamp'], expensifyTimestampFormat)
+			except ValueError as ex:
+				errors.append(('Timestamp', str(ex)))
+		for field in ['Amount', 'Original Amount']:
+			if exp.get(field) != None:
+				try:
+					self.atof(exp[field])
+				except ValueError:
+					errors.append((field, 'not an amount in this locale: "%s"' \
+						% exp[field]))
+		return errors
+
+	# Rows are converted one at a time as the caller asks for them, so
+	# a huge dump never has to be held in memory all at once
 	def getExpenses(self):
-		return map(self.convertExpense, self.rdr)
+		convertExpense = profiler.wrap('convertExpense', self.convertExpense)
+		if profiler.enabled:
+			self.atof = profiler.wrap('atof', self.atof)
+		for exp in profiler.timedIterator('csvParse', self.rdr, 'rowsParsed'):
+			if self.rowFilter != None and not self.rowFilter( \
+					self.rdr.fieldnames, \
+					[exp[field] for field in self.rdr.fieldnames]):
+				continue
+			yield convertExpense(exp)
+
+	# As getExpenses, but also checking that Expensify converted to the
+	# currency we expected (see checkCurrency)
+	def getCheckedExpenses(self, homeCurrency):
+		for exp in self.getExpenses():
+			checkCurrency(exp, homeCurrency)
+			yield exp
 
 	def getExpensifyCategories(self):
 		return self.mapExpensifyFieldToExpenseType.keys()
 
+	# Same dict csv.DictReader would have made of the row
+	def rowDict(self, row):
+		exp = dict(zip(self.fieldnames, row))
+		for field in self.fieldnames[len(row):]:
+			exp[field] = None
+		if len(row) > len(self.fieldnames):
+			exp[None] = row[len(self.fieldnames):]
+		return exp
+
+# The same Expensify format, converted by a pool of worker processes.
+# The dump is memory-mapped and cut into chunks that each end at the end
+# of a record, so a worker can parse its chunk with csv.reader on its own.
+# Workers hand back each row converted to a compact tuple, or the
+# exception converting it raised, and the chunks are put back in file
+# order here, so the expenses (and the exceptions) that come out are
+# exactly the ones ExpensifyFormatV1 would produce. A rowFilter still
+# runs here, on the rows the workers send back with their results.
+#
+# Cutting the dump only needs to know whether a newline is inside a
+# quoted field, which is whether an odd number of quotes come before it.
+# That holds for any csv that quotes fields the way Expensify (and the
+# csv module) does; a stray quote in the middle of an unquoted field
+# would throw it off.
+class ExpensifyChunkedFormatV1(ExpensifyFormatV1):
+	chunkSizeMax = 4 << 20
+	chunkSizeMin = 64 << 10
+
+	def __init__(self, jobs):
+		self.jobs = jobs
+
+	def initExpensifyDump(self, f):
+		self.fnExpensifyDump = f.name
+		self.size = os.fstat(f.fileno()).st_size
+		self.fieldnames = None
+		if self.size == 0:
+			return
+		mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			# the first row is the header, as for csv.DictReader, even
+			# if it's blank
+			self.dataStart = self.recordEnd(mm, 0)
+			self.fieldnames = next(csv.reader(cStringIO.StringIO( \
+				mm[0:self.dataStart])), [])
+			self.chunkEnds = self.findChunkEnds(mm)
+		finally:
+			mm.close()
+
+	# Where the record that pos is the start of (or in the middle of,
+	# outside quotes) ends: just past the first newline with an even
+	# number of quotes between pos and it
+	def recordEnd(self, mm, pos):
+		quotes = 0
+		while True:
+			newline = mm.find('\n', pos)
+			if newline == -1:
+				return self.size
+			quotes += mm[pos:newline].count('"')
+			if quotes % 2 == 0:
+				return newline + 1
+			pos = newline + 1
+
+	def findChunkEnds(self, mm):
+		chunkSize = (self.size - self.dataStart) / (self.jobs * 4)
+		chunkSize = max(self.chunkSizeMin, min(self.chunkSizeMax, chunkSize))
+		chunkEnds = []
+		start = self.dataStart
+		quotes = 0
+		while start < self.size:
+			end = min(start + chunkSize, self.size)
+			if end < self.size:
+				# the quotes from the start of this chunk tell us
+				# whether end is inside a quoted field
+				quotes = mm[start:end].count('"')
+				newline = mm.find('\n', end)
+				while newline != -1:
+					quotes += mm[end:newline].count('"')
+					if quotes % 2 == 0:
+						break
+					end = newline + 1
+					newline = mm.find('\n', end)
+				end = self.size if newline == -1 else newline + 1
+			chunkEnds.append(end)
+			start = end
+		return chunkEnds
+
+	def getCheckedExpenses(self, homeCurrency):
+		if self.fieldnames == None:
+			return
+		import multiprocessing
+		keepRows = self.rowFilter != None
+		starts = [self.dataStart] + self.chunkEnds[:-1]
+		tasks = iter([(self.fnExpensifyDump, start, end, self.fieldnames, \
+			self.amountLocale, homeCurrency, keepRows) \
+			for (start, end) in zip(starts, self.chunkEnds)])
+		pool = multiprocessing.Pool(self.jobs)
+		try:
+			# keep every worker busy, without parsing far ahead of
+			# whoever is taking the expenses
+			pending = collections.deque( \
+				pool.apply_async(convertExpensifyChunk, (task,)) \
+				for task in itertools.islice(tasks, self.jobs * 2))
+			while len(pending) > 0:
+				records, error = pending.popleft().get()
+				for task in itertools.islice(tasks, 1):
+					pending.append(pool.apply_async(convertExpensifyChunk, \
+						(task,)))
+				profiler.count('rowsParsed', len(records))
+				for row, record in records:
+					if keepRows and not self.rowFilter(self.fieldnames, row):
+						continue
+					if isinstance(record, Exception):
+						raise record
+					yield Expense(record[0], date.fromordinal(record[1]), \
+						record[2], record[3], record[4], record[5], record[6])
+				if error != None:
+					raise error
+		finally:
+			# whether we're done, failed or just weren't wanted any more,
+			# at most jobs * 2 chunks are left in hand; let them finish
+			pool.close()
+			pool.join()
+
+	def getExpenses(self):
+		return self.getCheckedExpenses(None)
+
+# Runs in an ingest worker: parse and convert one chunk of a dump (see
+# ExpensifyChunkedFormatV1). Returns a (row, record) pair per row, the
+# record being the expense as a tuple, or the exception it raised, and
+# row its fields if keepRows, for the parent's rowFilter; and the csv
+# error that stopped the chunk early, if one did.
+def convertExpensifyChunk(task):
+	fnExpensifyDump, start, end, fieldnames, amountLocale, homeCurrency, \
+		keepRows = task
+	with open(fnExpensifyDump, 'rb') as fExpensifyDump:
+		fExpensifyDump.seek(start)
+		chunk = fExpensifyDump.read(end - start)
+	wrapper = ExpensifyFormatV1()
+	if amountLocale != None:
+		wrapper.setAmountLocale(amountLocale)
+	wrapper.fieldnames = fieldnames
+	records = []
+	try:
+		for row in csv.reader(cStringIO.StringIO(chunk)):
+			# csv.DictReader skips blank lines, so we do too
+			if len(row) == 0:
+				continue
+			try:
+				exp = wrapper.convertExpense(wrapper.rowDict(row))
+				if homeCurrency != None:
+					checkCurrency(exp, homeCurrency)
+				record = (exp.expenseType, exp.date.toordinal(), \
+					exp.description, exp.amount, exp.merchant, \
+					exp.origCurrency, exp.origAmount)
+			except Exception as ex:
+				record = ex
+			records.append((row if keepRows else None, record))
+	except csv.Error as ex:
+		return records, ex
+	return records, None
+
+# The same Expensify format, but converted a block of rows at a time
+# with numpy instead of one row at a time. Any row that doesn't pass the
+# vectorized checks is handed to the row-wise convertExpense and
+# checkCurrency, so the expenses (and the exceptions) that come out are
+# exactly the ones ExpensifyFormatV1 would produce.
+class ExpensifyColumnarFormatV1(ExpensifyFormatV1):
+	blockSize = 65536
+
+	# "%Y-%m-%d %H:%M:%S", the only timestamp format with a fast path
+	timestampLen = 19
+	timestampDigits = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+	timestampSeparators = [(4, '-'), (7, '-'), (10, ' '), (13, ':'), (16, ':')]
+	daysInMonth = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+	columns = ['Category', 'Timestamp', 'Comment', 'Amount', 'Merchant', \
+		'Original Currency', 'Original Amount']
+
+	# stands in for rows that are missing fields, while they wait to be
+	# sent down the row-wise path
+	placeholder = {'Category':'Entertainment', \
+		'Timestamp':'2000-01-01 00:00:00', 'Comment':'', 'Amount':'1', \
+		'Merchant':'', 'Original Currency':'', 'Original Amount':'1'}
+
+	def __init__(self):
+		try:
+			import numpy
+		except ImportError:
+			raise ImportError("columnar parsing needs numpy")
+		self.numpy = numpy
+
+	def initExpensifyDump(self, f):
+		self.rdr = csv.reader(f)
+		self.fieldnames = next(self.rdr, [])
+
+	# Rows whose timestamps are exactly "YYYY-MM-DD HH:MM:SS" with a real
+	# date and time in them, and those dates
+	def convertTimestamps(self, timestamps):
+		numpy = self.numpy
+		ts = numpy.array(timestamps)
+		good = numpy.char.str_len(ts) == self.timestampLen
+		ts = ts.astype('S%d' % self.timestampLen)
+		chars = ts.view(numpy.uint8).reshape(len(ts), self.timestampLen)
+		for i, sep in self.timestampSeparators:
+			good &= chars[:, i] == ord(sep)
+		digits = chars[:, self.timestampDigits].astype(numpy.int32) - ord('0')
+		good &= ((digits >= 0) & (digits <= 9)).all(axis = 1)
+
+		def field(first, count):
+			value = numpy.zeros(len(ts), numpy.int32)
+			for i in range(first, first + count):
+				value = value * 10 + digits[:, i]
+			return value
+		year, month, day = field(0, 4), field(4, 2), field(6, 2)
+		hour, minute, second = field(8, 2), field(10, 2), field(12, 2)
+		good &= (hour <= 23) & (minute <= 59) & (second <= 59)
+		good &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+		leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+		monthLength = numpy.array(self.daysInMonth)[(month - 1) % 12] + \
+			((month == 2) & leap)
+		good &= day <= monthLength
+
+		days = numpy.where(good, ts.astype('S10'), '2000-01-01')
+		return good, days.astype('datetime64[D]').tolist()
+
+	# Same as atof over the whole column. Rows that float()
+	# won't take are marked bad rather than raising.
+	def convertAmounts(self, amounts):
+		numpy = self.numpy
+		if self.amountLocale != None:
+			thousandsSep, decimalPoint = numericConventions(self.amountLocale)
+		else:
+			conv = locale.localeconv()
+			thousandsSep, decimalPoint = conv['thousands_sep'], conv['decimal_point']
+		a = numpy.array(amounts)
+		if thousandsSep:
+			a = numpy.char.replace(a, thousandsSep, '')
+		if decimalPoint and decimalPoint != '.':
+			a = numpy.char.replace(a, decimalPoint, '.')
+		try:
+			return numpy.ones(len(a), bool), a.astype(numpy.float64).tolist()
+		except ValueError:
+			good = numpy.ones(len(a), bool)
+			values = [0.0] * len(a)
+			for i, s in enumerate(a.tolist()):
+				try:
+					values[i] = float(s)
+				except ValueError:
+					good[i] = False
+			return good, values
+
+	def convertCategories(self, categories):
+		numpy = self.numpy
+		uniq, inverse = numpy.unique(numpy.array(categories), \
+			return_inverse = True)
+		expenseTypes = numpy.array([self.mapExpensifyFieldToExpenseType.get(c) \
+			for c in uniq.tolist()] + [None], dtype = object)
+		expenseTypes = expenseTypes[inverse]
+		return numpy.not_equal(expenseTypes, None), expenseTypes.tolist()
+
+	def convertBlock(self, rows, homeCurrency):
+		numpy = self.numpy
+		if not all(field in self.fieldnames for field in self.columns):
+			# every row will fail; let convertExpense say why
+			for row in rows:
+				exp = self.convertExpense(self.rowDict(row))
+				if homeCurrency != None:
+					checkCurrency(exp, homeCurrency)
+				yield exp
+			return
+
+		indices = [self.fieldnames.index(field) for field in self.columns]
+		good = numpy.ones(len(rows), bool)
+		if min(map(len, rows)) <= max(indices):
+			short = set(i for (i, row) in enumerate(rows) \
+				if len(row) <= max(indices))
+			good[list(short)] = False
+			placeholder = [''] * (max(indices) + 1)
+			for field, i in zip(self.columns, indices):
+				placeholder[i] = self.placeholder[field]
+			convertRows = [placeholder if i in short else row \
+				for (i, row) in enumerate(rows)]
+		else:
+			convertRows = rows
+
+		(categories, timestamps, comments, amounts, merchants, \
+			origCurrencies, origAmounts) = \
+			[map(operator.itemgetter(i), convertRows) for i in indices]
+
+		goodTypes, expenseTypes = self.convertCategories(categories)
+		goodDates, dates = self.convertTimestamps(timestamps)
+		goodAmounts, amounts = self.convertAmounts(amounts)
+		goodOrigAmounts, origAmounts = self.convertAmounts(origAmounts)
+		good &= goodTypes & goodDates & goodAmounts & goodOrigAmounts
+
+		# the currency checks from checkCurrency, across the block
+		if homeCurrency != None:
+			a = numpy.array(amounts)
+			o = numpy.array(origAmounts)
+			same = numpy.array(origCurrencies) == homeCurrency
+			good &= numpy.where(same, a == o, a != o)
+
+		for i, ok in enumerate(good.tolist()):
+			if ok:
+				yield Expense(expenseTypes[i], dates[i], comments[i], \
+					amounts[i], merchants[i], origCurrencies[i], \
+					origAmounts[i])
+			else:
+				exp = self.convertExpense(self.rowDict(rows[i]))
+				if homeCurrency != None:
+					checkCurrency(exp, homeCurrency)
+				yield exp
+
+	def getCheckedExpenses(self, homeCurrency):
+		while True:
+			with profiler.timed('csvParse'):
+				block = list(itertools.islice(self.rdr, self.blockSize))
+			if len(block) == 0:
+				return
+			profiler.count('rowsParsed', len(block))
+			# csv.DictReader skips blank lines, so we do too
+			rows = filter(None, block)
+			if self.rowFilter != None:
+				rows = [row for row in rows \
+					if self.rowFilter(self.fieldnames, row)]
+			if len(rows) > 0:
+				for exp in profiler.timedIterator('convertBlock', \
+						self.convertBlock(rows, homeCurrency)):
+					yield exp
+
+	def getExpenses(self):
+		return self.getCheckedExpenses(None)
+
 # should put some unit testing code here!
 
 #########################
@@ -479,31 +1013,714 @@ def addressConvert(address):
 
 # General writer function for writing into spreadsheet
 # Handed into ExpenseV3 class so it doesn't need to
-# know about the specifics of xlwt
-def writer(st, address, value, style = textStyle):
-	r, c = addressConvert(address)
-	st.write(r, c, value, style)
-
-# same as above, but for writing formulas
-def formulaWriter(st, address, value, style = currencyStyle):
-	writer(st, address, xlwt.Formula(value), style)
+# know about the specifics of xlwt. Writes a batch of
+# (row, col, value, style) cells, with rows and columns
+# numbered as xlwt does; a style of None means textStyle
+def writer(st, cells):
+	lastRow = None
+	for r, c, value, style in cells:
+		if r != lastRow:
+			row = st.row(r)
+			lastRow = r
+		if style == None:
+			style = textStyle
+		row.write(c, value, style)
+
+# same as above, but for writing formulas, given as text;
+# a style of None means currencyStyle
+def formulaWriter(st, cells):
+	writer(st, [(r, c, xlwt.Formula(formula), \
+		currencyStyle if style == None else style) \
+		for (r, c, formula, style) in cells])
+
+# What each column of a section can hold, as a function of the entry on
+# that row, and whether it's an amount (written with currencyStyle).
+# Travel rows are a day's expenses (DailyExpenseAccumulator), and their
+# other columns are each an expense type's total for the day; the rest
+# are single Expenses.
+travelColumnValues = { \
+	'date':(lambda exp: str(exp.date), False), \
+	'description':(lambda exp: str(exp.description), False) \
+}
+expenseColumnValues = { \
+	'date':(lambda exp: str(exp.date), False), \
+	'description':(lambda exp: str(exp.description), False), \
+	'merchant':(lambda exp: str(exp.merchant), False), \
+	'merchantDescription':(lambda exp: \
+		str(exp.merchant) + ': ' + str(exp.description), False), \
+	'amount':(lambda exp: exp.amount, True), \
+	'businessPurpose':(lambda exp: BUSINESSPURPOSE, False), \
+	'department':(lambda exp: DEPARTMENT, False) \
+}
+# What the "{name}"s in a layout's fields are filled in with; see
+# ExpenseV3.writeMandatoryData
+layoutFieldNames = ['currency', 'name', 'businessPurpose', 'department', \
+	'periodCovered', 'today']
+layoutFieldRe = re.compile(r'\{(\w+)\}')
+
+# json gives unicode, but the sheets are written with str
+def layoutText(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+# "A12", or a range of them like "F14:P14", as the (row, col) addresses
+# it covers, in rows then columns
+def layoutAddresses(cells):
+	first, _, last = cells.partition(':')
+	firstRow, firstCol = addressConvert(first)
+	lastRow, lastCol = addressConvert(last or first)
+	return [(r, c) for r in range(firstRow, lastRow + 1) \
+		for c in range(firstCol, lastCol + 1)]
+
+# One section of a layout: the first row it takes up on the form and
+# how many, which is how many entries the section holds. cells has the
+# (row, columns) of each of those rows, ready for writeSectionRow; travel
+# sections also have the (expense type, col) columns their totals go in.
+class LayoutSection:
+	def __init__(self, name, spec, columnValues, categories):
+		self.firstRow = int(spec['firstRow'])
+		self.rows = int(spec['rows'])
+		if self.firstRow < 1 or self.rows < 1:
+			raise InvalidLayout('%s section needs firstRow and rows of 1 or more' \
+				% name)
+		columns = []
+		self.categoryColumns = []
+		for column, value in sorted(spec['columns'].items()):
+			column = layoutText(column)
+			value = layoutText(value)
+			if value in columnValues:
+				columns.append((colConvert(column),) + columnValues[value])
+			elif value in categories:
+				self.categoryColumns.append((value, colConvert(column)))
+			else:
+				raise InvalidLayout('%s section has no "%s" to put in column %s' \
+					% (name, value, column))
+		missing = set(categories) - set(c for (c, col) in self.categoryColumns)
+		if len(missing) > 0:
+			raise InvalidLayout('%s section has no column for %s' % \
+				(name, ', '.join(sorted(missing))))
+		self.cells = [(rowConvert(self.firstRow + i), columns) \
+			for i in range(self.rows)]
+
+# A report layout: which sheet of a template it fills in, and where
+# everything goes on it, read from a layout file (see layouts/) and
+# compiled, once, into tables of (row, col) addresses as xlwt numbers
+# them, so that filling in a sheet never has to build or parse an "A12"
+# string.
+#
+# formulaCells are the (row, col, formula, style) cells of its formulas;
+# xlutils can't copy formulas over from the template, so these get
+# recreated. A formula given for a range of cells has {row} and {col} in
+# it replaced for each. fieldCells are the (row, col, text, names) of
+# its fields, text being a % format of the names it's filled in with.
+#
+# Packed sheets are pickled across to worker processes, and their
+# layout goes by name, from reportLayouts.
+class ReportLayout(object):
+	def __init__(self, spec, digest):
+		try:
+			self.name = layoutText(spec['name'])
+			self.sheetName = layoutText(spec['sheet'])
+			self.digest = digest
+			travelCategories = set( \
+				ExpensifyFormatV1.mapExpensifyFieldToExpenseType.values()) - \
+				set(['entertainment', 'miscellaneous'])
+			self.travel = LayoutSection('travel', spec['travel'], \
+				travelColumnValues, travelCategories)
+			self.entertainment = LayoutSection('entertainment', \
+				spec['entertainment'], expenseColumnValues, [])
+			self.miscellaneous = LayoutSection('miscellaneous', \
+				spec['miscellaneous'], expenseColumnValues, [])
+
+			self.fieldCells = []
+			for field in spec.get('fields', []):
+				text = layoutText(field['text'])
+				names = layoutFieldRe.findall(text)
+				for name in names:
+					if name not in layoutFieldNames:
+						raise InvalidLayout('no field {%s} to fill in %s with' \
+							% (name, field['cell']))
+				text = layoutFieldRe.sub(r'%(\1)s', text.replace('%', '%%'))
+				for r, c in layoutAddresses(layoutText(field['cell'])):
+					self.fieldCells.append((r, c, text, names))
+
+			self.formulaCells = []
+			for formula in spec.get('formulas', []):
+				text = layoutText(formula['formula'])
+				for r, c in layoutAddresses(layoutText(formula['cells'])):
+					self.formulaCells.append((r, c, text. \
+						replace('{row}', str(r + 1)). \
+						replace('{col}', chr(ord('A') + c)), None))
+		except KeyError as ex:
+			raise InvalidLayout('layout is missing %s' % ex)
+		except (AssertionError, ValueError, TypeError, AttributeError):
+			raise InvalidLayout('layout has a bad cell, column or row')
+
+	def __reduce__(self):
+		return (reportLayout, (self.name,))
+
+# The layouts loaded so far, by name; the ones in layoutsDir are loaded
+# the first time any layout is asked for
+layoutsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'layouts')
+defaultLayoutName = 'expense_v3'
+reportLayouts = {}
+
+# Load every *.json layout file in dirLayouts, alongside the layouts
+# already loaded; one with the same name as a loaded one replaces it.
+# Returns the layouts loaded.
+def loadReportLayouts(dirLayouts):
+	import glob, json
+	layouts = []
+	for fnLayout in sorted(glob.glob(os.path.join(dirLayouts, '*.json'))):
+		with open(fnLayout, 'rb') as fLayout:
+			data = fLayout.read()
+		try:
+			layout = ReportLayout(json.loads(data), hashlib.sha1(data).hexdigest())
+		except ValueError as ex:
+			raise InvalidLayout('%s: %s' % (fnLayout, ex))
+		except InvalidLayout as ex:
+			raise InvalidLayout('%s: %s' % (fnLayout, ex.value))
+		reportLayouts[layout.name] = layout
+		layouts.append(layout)
+	return layouts
+
+def getReportLayouts():
+	if defaultLayoutName not in reportLayouts:
+		loadReportLayouts(layoutsDir)
+	return reportLayouts
+
+def reportLayout(name):
+	layouts = getReportLayouts()
+	if name not in layouts:
+		raise InvalidLayout('No "%s" report layout loaded' % name)
+	return layouts[name]
+
+# The layout for a template with these sheets: the first sheet that a
+# loaded layout is for decides it
+def templateLayout(sheetNames, fnBlankSpreadsheet):
+	layoutsBySheet = dict((layout.sheetName, layout) \
+		for (name, layout) in sorted(getReportLayouts().items(), reverse = True))
+	for sheetIndex, sheetName in enumerate(sheetNames):
+		if layoutText(sheetName) in layoutsBySheet:
+			return layoutsBySheet[layoutText(sheetName)], sheetIndex
+	raise InvalidVersion('No worksheet in %s that a report layout (%s) is for' \
+		% (fnBlankSpreadsheet, ', '.join(sorted(reportLayouts))))
+
+# What the loaded layouts are, for keying compiled templates on
+def reportLayoutsDigest():
+	return ','.join('%s=%s' % (name, layout.digest) \
+		for (name, layout) in sorted(getReportLayouts().items()))
 
 #########################
 # THE PROCESSING BEGINS #
 #########################
 
-expensifyWrapper = ExpensifyFormatV1()
+# Everything that is specific to one person's report. Handed into
+# ExpenseV3 so that it doesn't need to reach for module globals, and
+# so that one process can produce reports for many people.
+class ReportConfig:
+	def __init__(self, name, currency = 'USD', uplift = 0.0, locale = 'en_US'):
+		self.yourName = name
+		self.homeCurrency = currency
+		# uplift is a percentage, e.g. 4.5; we store the fraction
+		self.currencyUpliftPerc = float(uplift) / 100.0
+		self.expensifyLocale = locale
+
+# How a conversion is run, as opposed to what goes into the report.
+# jobs: number of worker processes saving sheets
+# columnar: parse the dump with numpy, a block of rows at a time
+# ingestJobs: parse the dump in this many worker processes
+# packing: 'greedy' fills sheets in file order, 'optimal' uses the fewest
+# sinceLastRun: ProcessedExpenseIndex file; skip rows already reported
+# pipeline: with one job, save sheets on a background thread
+# archive: zip file to save every sheet into, instead of one file each
+# duplicates: 'flag' or 'drop' charges that come in twice, within
+# duplicateDays and duplicateAmount; duplicateHistory: ExpenseHistory
+# file to check against (and add to) as well
+class ConvertOptions:
+	packingModes = ['greedy', 'optimal']
+	duplicateModes = ['flag', 'drop']
+
+	def __init__(self, jobs = 1, columnar = False, packing = 'greedy', \
+			sinceLastRun = None, pipeline = False, archive = None, \
+			ingestJobs = 1, duplicates = None, duplicateDays = 0, \
+			duplicateAmount = 0.0, duplicateHistory = None):
+		self.jobs = jobs
+		self.columnar = columnar
+		self.ingestJobs = ingestJobs
+		self.packing = packing
+		self.sinceLastRun = sinceLastRun
+		self.pipeline = pipeline
+		self.archive = archive
+		self.duplicates = duplicates
+		self.duplicateDays = duplicateDays
+		self.duplicateAmount = duplicateAmount
+		self.duplicateHistory = duplicateHistory
+
+# Fingerprints of every Expensify row that has already gone into a report.
+# Each month's export repeats most of the last one, so with this kept
+# between runs only the new rows need converting. The fingerprint is a
+# hash of the person's name and the row's fields, so it doesn't matter
+# if Expensify reorders its columns. The whole index is loaded into a set,
+# so checking a row is a single lookup.
+class ProcessedExpenseIndex:
+	def __init__(self, fnIndex):
+		import sqlite3
+		self.db = sqlite3.connect(fnIndex)
+		self.db.execute("CREATE TABLE IF NOT EXISTS processed " \
+			"(fingerprint BLOB PRIMARY KEY)")
+		self.processed = set(str(fingerprint) for (fingerprint,) in \
+			self.db.execute("SELECT fingerprint FROM processed"))
+
+	# Row filter for readers that passes only rows not in the index.
+	# The fingerprints of the rows it passes are appended to
+	# newFingerprints, to be add()ed once they've been reported.
+	def rowFilter(self, name, newFingerprints):
+		return ProcessedExpenseFilter(self.processed, name, newFingerprints)
+
+	def add(self, fingerprints):
+		import sqlite3
+		self.db.executemany("INSERT OR IGNORE INTO processed VALUES (?)", \
+			[(sqlite3.Binary(fingerprint),) for fingerprint in fingerprints])
+		self.db.commit()
+		self.processed.update(fingerprints)
+
+	# Have rowFilters pass over these from now on, before they are add()ed
+	def skip(self, fingerprints):
+		self.processed.update(fingerprints)
+
+	def close(self):
+		self.db.close()
+
+class ProcessedExpenseFilter:
+	def __init__(self, processed, name, newFingerprints):
+		self.processed = processed
+		self.name = name
+		self.newFingerprints = newFingerprints
+		self.fieldnames = None
+
+	def __call__(self, fieldnames, row):
+		if fieldnames is not self.fieldnames:
+			# fields are hashed in name order
+			self.fieldnames = fieldnames
+			self.order = sorted(range(len(fieldnames)), \
+				key = fieldnames.__getitem__)
+		fields = [self.name]
+		for i in self.order:
+			fields.append(fieldnames[i])
+			if i < len(row) and row[i] != None:
+				fields.append(row[i])
+			else:
+				fields.append('')
+		fingerprint = hashlib.sha1('\x1f'.join(fields)).digest()
+		if fingerprint in self.processed:
+			return False
+		self.newFingerprints.append(fingerprint)
+		return True
+
+# Every expense that has gone into someone's reports, kept between runs
+# so that a charge turning up again in a later export (one that
+# overlaps the last, or another card's) can be caught by a
+# DuplicateExpenseDetector. Dates are kept as ordinals and amounts in
+# cents.
+class ExpenseHistory:
+	def __init__(self, fnHistory):
+		import sqlite3
+		self.db = sqlite3.connect(fnHistory)
+		self.db.execute("CREATE TABLE IF NOT EXISTS expenses " \
+			"(name TEXT, date INTEGER, merchant TEXT, origCurrency TEXT, " \
+			"origAmount INTEGER)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS expensesByName " \
+			"ON expenses (name)")
+
+	def load(self, name):
+		return [(date, str(merchant), str(origCurrency), origAmount) \
+			for (date, merchant, origCurrency, origAmount) in \
+			self.db.execute("SELECT date, merchant, origCurrency, " \
+			"origAmount FROM expenses WHERE name = ?", (name,))]
+
+	def add(self, name, records):
+		self.db.executemany("INSERT INTO expenses VALUES (?, ?, ?, ?, ?)", \
+			[(name,) + record for record in records])
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+# Catches the same charge coming in twice: same merchant and original
+# currency, with a date within days and an original amount within
+# amount of one already seen. (The amount in the home currency is
+# derived from those, and can differ between exports with the exchange
+# rate, so it isn't compared.) Expenses are hashed into buckets as wide
+# as the tolerances, so checking one is a handful of dict lookups: its
+# own bucket and, if there is any tolerance, the ones either side.
+class DuplicateExpenseDetector:
+	def __init__(self, days = 0, amount = 0.0):
+		self.days = days
+		self.cents = int(round(amount * 100))
+		self.buckets = collections.defaultdict(list)
+		if self.days == 0 and self.cents == 0:
+			self.neighbours = [(0, 0)]
+		else:
+			self.neighbours = [(d, c) for d in (-1, 0, 1) for c in (-1, 0, 1)]
+
+	@staticmethod
+	def record(exp):
+		return (exp.date.toordinal(), exp.merchant, exp.origCurrency, \
+			int(round(exp.origAmount * 100)))
+
+	def bucket(self, record):
+		date, merchant, origCurrency, origAmount = record
+		return (merchant, origCurrency, date // (self.days + 1), \
+			origAmount // (self.cents + 1))
+
+	# The earlier record that record duplicates, if any
+	def find(self, record):
+		date, merchant, origCurrency, origAmount = record
+		merchant, origCurrency, dateBucket, amountBucket = self.bucket(record)
+		for d, c in self.neighbours:
+			for other in self.buckets.get((merchant, origCurrency, \
+					dateBucket + d, amountBucket + c), ()):
+				if abs(other[0] - date) <= self.days and \
+						abs(other[3] - origAmount) <= self.cents:
+					return other
+		return None
+
+	def add(self, record):
+		self.buckets[self.bucket(record)].append(record)
+
+# Pass expenses on, flagging or (mode 'drop') leaving out any that
+# duplicate one earlier in this report or in history. The records of
+# those passed on are collected in newRecords, for adding to history
+# once the report has been saved.
+def checkDuplicates(expenses, detector, mode, newRecords):
+	for exp in expenses:
+		record = detector.record(exp)
+		other = detector.find(record)
+		if other != None:
+			profiler.count('duplicates')
+			print "%s duplicate: %s %s %s%.2f (already have %s %s%.2f)" % \
+				("Dropping" if mode == 'drop' else "Possible", \
+				str(exp.date), exp.merchant, exp.origCurrency, \
+				exp.origAmount, str(date.fromordinal(other[0])), \
+				other[2], other[3] / 100.0)
+			if mode == 'drop':
+				continue
+		detector.add(record)
+		newRecords.append(record)
+		yield exp
+
+# The expense stream with checkDuplicates applied, if options ask for it,
+# against what history has for this person, and the records of theirs
+# that earlier reports of the same batch took (batchRecords)
+def duplicateChecked(expenses, config, options, history, newRecords, \
+		batchRecords = None):
+	if options == None or options.duplicates == None:
+		return expenses
+	detector = DuplicateExpenseDetector(options.duplicateDays, \
+		options.duplicateAmount)
+	if history != None:
+		for record in history.load(config.yourName):
+			detector.add(record)
+	if batchRecords != None:
+		for record in batchRecords:
+			detector.add(record)
+	return checkDuplicates(expenses, detector, options.duplicates, newRecords)
+
+# Counters and timers for the stages of a run, switched on with
+# --profile. Stages that happen once per template or sheet (copying the
+# form, recreating formulas, saving) are timed() as spans, which also go
+# into a Chrome trace. Stages that happen once per row (reading the csv,
+# convertExpense, atof, combine) would cost more than they measure
+# as spans, so their time is only added up, through wrap() and
+# timedIterator().
+#
+# While profiling is off, profiler is a NullProfiler: wrap() and
+# timedIterator() hand back what they were given, and the rest do
+# nothing, so the per-row paths cost exactly what they did before.
+class NullProfiler:
+	enabled = False
+
+	class NullSpan:
+		def __enter__(self):
+			pass
+		def __exit__(self, *exc):
+			return False
+	nullSpan = NullSpan()
+
+	def count(self, name, n = 1):
+		pass
+
+	def timed(self, name):
+		return self.nullSpan
 
-usage = sys.argv[0] + """ [-l <locale>] [-c <currency>] [-u <curr_uplift>] <name> <expensify_dump> <input_sheet>
+	def wrap(self, name, f):
+		return f
+
+	def timedIterator(self, name, iterable, counter = None):
+		return iterable
+
+	def drain(self):
+		return None
+
+	def merge(self, profile):
+		pass
+
+class StageProfiler:
+	enabled = True
+
+	class Span:
+		def __init__(self, profiler, name):
+			self.profiler = profiler
+			self.name = name
+		def __enter__(self):
+			self.start = time.time()
+		def __exit__(self, *exc):
+			end = time.time()
+			self.profiler.add(self.name, end - self.start)
+			self.profiler.events.append((self.name, os.getpid(), \
+				thread.get_ident(), self.start, end - self.start))
+			return False
+
+	def __init__(self):
+		self.started = time.time()
+		self.reset()
+
+	def reset(self):
+		self.counters = collections.defaultdict(int)
+		# name -> [calls, seconds]
+		self.timers = collections.defaultdict(lambda: [0, 0.0])
+		# (name, pid, tid, start, seconds) of every span; spans on one
+		# thread nest, those on different threads (see
+		# BackgroundSheetWriter) needn't
+		self.events = []
+
+	def count(self, name, n = 1):
+		self.counters[name] += n
+
+	def add(self, name, seconds, calls = 1):
+		timer = self.timers[name]
+		timer[0] += calls
+		timer[1] += seconds
+
+	def timed(self, name):
+		return self.Span(self, name)
+
+	def wrap(self, name, f):
+		clock = time.time
+		def timedCall(*args):
+			start = clock()
+			try:
+				return f(*args)
+			finally:
+				self.add(name, clock() - start)
+		return timedCall
+
+	# The time spent in next(), e.g. by csv.reader, not by the caller
+	def timedIterator(self, name, iterable, counter = None):
+		clock = time.time
+		iterator = iter(iterable)
+		while True:
+			start = clock()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				self.add(name, clock() - start, 0)
+				return
+			self.add(name, clock() - start)
+			if counter != None:
+				self.counters[counter] += 1
+			yield item
+
+	# Hand over what has been recorded here since the last drain, e.g.
+	# from a pool worker to the process that writes the report
+	def drain(self):
+		profile = (dict(self.counters), dict(self.timers), self.events)
+		self.reset()
+		return profile
+
+	def merge(self, profile):
+		if profile == None:
+			return
+		counters, timers, events = profile
+		for name, n in counters.iteritems():
+			self.count(name, n)
+		for name, (calls, seconds) in timers.iteritems():
+			self.add(name, seconds, calls)
+		self.events.extend(events)
+
+	def report(self):
+		wallSeconds = time.time() - self.started
+		counters = dict(self.counters)
+		rates = {}
+		if wallSeconds > 0:
+			rates['rowsPerSecond'] = \
+				round(counters.get('rowsParsed', 0) / wallSeconds, 1)
+			rates['sheetsPerSecond'] = \
+				round(counters.get('sheetsSaved', 0) / wallSeconds, 1)
+		return { \
+			'wallSeconds':round(wallSeconds, 6), \
+			'counters':counters, \
+			'rates':rates, \
+			'timers':dict((name, {'calls':calls, 'seconds':round(seconds, 6)}) \
+				for (name, (calls, seconds)) in self.timers.iteritems() \
+				if calls > 0) \
+		}
+
+	# Chrome's about://tracing (or Perfetto) format: every span as a
+	# complete event, each process on its own row, and the added-up
+	# timers and counters in otherData
+	def chromeTrace(self):
+		events = [{'name':name, 'ph':'X', 'pid':pid, 'tid':tid, \
+			'ts':round((start - self.started) * 1e6, 1), \
+			'dur':round(seconds * 1e6, 1)} \
+			for (name, pid, tid, start, seconds) in self.events]
+		events.append({'name':'counters', 'ph':'C', 'pid':os.getpid(), \
+			'ts':round((time.time() - self.started) * 1e6, 1), \
+			'args':dict(self.counters)})
+		return {'traceEvents':events, 'displayTimeUnit':'ms', \
+			'otherData':self.report()}
+
+	def writeReport(self, fnReport, reportFormat = 'json'):
+		import json
+		if reportFormat == 'chrome':
+			report = self.chromeTrace()
+		else:
+			report = self.report()
+		with open(fnReport, 'wb') as fReport:
+			json.dump(report, fReport, indent = 2, sort_keys = True)
+
+profilerFormats = ['json', 'chrome']
+profiler = NullProfiler()
+
+# Switch on profiling for everything that follows, in this process and
+# any pool it starts
+def startProfiling():
+	global profiler
+	profiler = StageProfiler()
+	return profiler
+
+# Pool workers inherit whatever the parent had recorded when it forked;
+# start them from nothing, so that only their own work is drained back
+def resetWorkerProfiler():
+	if profiler.enabled:
+		profiler.reset()
+
+# The blank expense form. Reading it with formatting_info, copying it
+# and recreating the formulas is slow, so it is only done once, however
+# many sheets or reports come out of it: the result is kept compiled,
+# and every output sheet gets its own copy. If cacheDir is given, the
+# compiled form is also kept there, keyed by a hash of the template.
+# An .xlsx template gives .xlsx sheets (see outputBackend).
+# Its layout is the loaded ReportLayout for one of its sheets (see
+# templateLayout); sheets must be packed with that layout to be copies
+# of it.
+class ExpenseTemplate:
+	def __init__(self, fnBlankSpreadsheet, cacheDir = None):
+		self.fnBlankSpreadsheet = fnBlankSpreadsheet
+		self.cacheDir = cacheDir
+		self.backend = outputBackend(fnBlankSpreadsheet)
+		self.compiled = None
+		if cacheDir != None:
+			fnCache = compiledTemplateCacheName(fnBlankSpreadsheet, cacheDir, \
+				self.backend)
+			self.compiled = readCompiledTemplate(fnCache)
+		if self.compiled == None:
+			self.compiled = self.backend.compile(fnBlankSpreadsheet)
+			if cacheDir != None:
+				writeCompiledTemplate(fnCache, self.compiled)
+		layoutName, self.form = self.backend.load(self.compiled)
+		self.layout = reportLayout(layoutName)
+
+	# Give an already-packed ExpenseV3 its own copy of the form
+	def attachExpenseSheetCopy(self, xpen):
+		if xpen.layout.name != self.layout.name:
+			raise InvalidLayout('Sheet packed for the %s layout, but %s is %s' \
+				% (xpen.layout.name, self.fnBlankSpreadsheet, self.layout.name))
+		self.backend.attach(self.form, xpen)
+		return xpen
+
+def getUsage(prog):
+	return prog + """ [-l <locale>] [-c <currency>] [-u <curr_uplift>] [-j <jobs>]
+	[--template-cache <dir>] [--columnar] [--ingest-jobs <jobs>] [--pipeline]
+	[--packing <mode>] [--since-last-run <index>] [--dry-run] [--validate]
+	[--zip <archive>]
+	[--duplicates <action>] [--duplicate-days <days>]
+	[--duplicate-amount <amount>] [--duplicate-history <history>]
+	[--profile <report>] [--profile-format <format>] [--layouts <layout_dir>]
+	[--layout <layout_name>]
+	[--shard-by <column>] [--shard-period <period>] [--shard-buffer <rows>]
+	<name> <expensify_dump>... <input_sheet>
+       """ + prog + """ [same options] -b <manifest> <input_sheet>
+       """ + prog + """ [same options] --serve <address> <input_sheet>
+       """ + prog + """ [same options] --shard <expensify_export> <input_sheet>
 
 locale:		Set locale associated with expensify_dump. Default is en_US.
 currency:	3-letter currency string. Default is USD.
 curr_uplift:	Floating point uplift % charged by credit card, e.g., 4.5
 name:		Your name, e.g. "John Hancock"
 expensify_dump:	Dumpfile from Expensify in .cvs format--must contain only ascii chars
-input_sheet:	Original expense spreadsheet in .xls format
-
-EXAMPLE: """ + sys.argv[0] + """ \"Fred Astaire\" ~/Downloads/Bulk_Export_id_DEFAULT_CSV.csv expense-form.xls
+		Give more than one (one per card, say) to merge them by date into
+		one set of sheets, named after the first.
+manifest:	CSV file with one "<name>,<expensify_dump>[,...][,<input_sheet>]"
+		line per report; a line's own input_sheet is filled in instead of
+		the one given for the batch.
+jobs:		Number of worker processes saving sheets (also --jobs). Default is 1.
+dir:		Directory to keep the compiled input_sheet in between runs.
+--columnar:	Parse expensify_dump in blocks with numpy; faster for huge dumps.
+--ingest-jobs:	Parse expensify_dump in this many processes at once, for huge
+		dumps on machines with cores to spare.
+--pipeline:	Save each sheet on a background thread while the next is being
+		read. Helps when saving waits on a slow disk or network share;
+		-j is what uses more CPUs. Ignored with more than one job.
+mode:		"greedy" fills sheets in file order (default); "optimal" uses the
+		fewest sheets, but reads the whole dump before writing any.
+index:		File recording which expenses have already been reported; only
+		expenses not in it are converted, and then added to it.
+--dry-run:	Don't write any sheets; print what they would hold as JSON.
+		input_sheet isn't needed; sheets are packed for its layout if it is
+		given, and otherwise for layout_name (by default, the built-in
+		expense_v3 layout).
+--validate:	Don't write any sheets; list every problem with every row (line
+		and field), then exit non-zero if there were any. input_sheet
+		isn't needed.
+archive:	Save every sheet of the run into this zip file, rather than
+		each to a file of its own next to its expensify_dump.
+action:		What to do with a charge that comes in twice for one person (same
+		merchant, original currency, date and original amount): "flag"
+		reports it and keeps it, "drop" leaves the second one out.
+days:		How many days apart duplicate charges can be. Default is 0.
+amount:		How far apart their original amounts can be. Default is 0.
+history:	File of every expense already reported, to look for duplicates
+		in as well; this run's are added to it. Implies --duplicates flag.
+address:	Keep input_sheet loaded and convert dumps POSTed to
+		http://<address>/convert?name=<name> (address is [host:]port),
+		answering with a zip of the sheets, with jobs conversions at a
+		time. GET /metrics reports request counts and latencies.
+report:		Write counters and timings for each stage of the run here.
+format:		"json" (default) for a summary, "chrome" for a trace that
+		about://tracing or Perfetto can show.
+expensify_export: A company-wide dump in .csv format, with every employee's
+		expenses in it. It is split, in one pass, into a dump per employee
+		and period, in a directory named after it (e.g. company/ for
+		company.csv), and each of those is converted as a report of its
+		own, as if listed in a manifest.
+column:		The export's column saying whose each expense is; it is the name
+		on their sheets. Default is Employee.
+period:		"month" (default), "year" or "all": how much of each employee's
+		expenses go into one dump.
+rows:		How many rows the split holds in memory before writing them
+		out to their dumps. Default is 100000.
+layout_dir:	Directory of *.json report layouts to load alongside the
+		built-in ones in layouts/, replacing any of the same name.
+layout_name:	The loaded layout a dry run packs sheets for without input_sheet.
+input_sheet:	Original expense spreadsheet in .xls or .xlsx format; the sheets
+		come out in the same format. .xlsx needs no xlrd, xlwt or xlutils.
+		The first of its worksheets that a loaded layout is for gets
+		filled in, as that layout has it.
+
+EXAMPLE: """ + prog + """ \"Fred Astaire\" ~/Downloads/Bulk_Export_id_DEFAULT_CSV.csv expense-form.xls
 
 Expensify config: You need to do the following in Expensify to use this tool:
 1. Go to Settings->Preferences and set default currency. This is what Expensify
@@ -515,52 +1732,7 @@ Expensify config: You need to do the following in Expensify to use this tool:
 3. Make sure your categories are set to the following. Every character needs to
    be exactly as written below. If these are not set correctly, you'll get an
    exception.
-""" + str(expensifyWrapper.getExpensifyCategories())
-
-try:
-	opts, args = getopt.getopt(sys.argv[1:],"hl:c:u:")
-except getopt.GetoptError:
-	print usage
-	sys.exit(2)
-
-# Defaults
-expensifyLocale = 'en_US'
-homeCurrency = 'USD'
-currencyUpliftPerc = 0.0
-
-for opt, arg in opts:
-	if opt == '-h':
-		print usage
-		sys.exit()
-	elif opt == "-l":
-		expensifyLocale = arg
-	elif opt == "-c":
-		homeCurrency = arg
-	elif opt == "-u":
-		currencyUpliftPerc = float(arg) / 100.0
-
-if len(args) < 3:
-	print usage
-	sys.exit(2)
-
-yourName = args[0]
-fnExpensifyDump = args[1]
-
-(fnExpensifyDumpPath, fnExpensifyDumpExt) = os.path.splitext(fnExpensifyDump)
-if fnExpensifyDumpExt != ".csv":
-	print "expensify_dump file must end in .csv"
-	print usage
-	sys.exit(2)
-
-fnBlankSpreadsheet = args[2]
-
-fnOutputSpreadsheetStem = fnExpensifyDumpPath
-
-# ESSENTIAL for interpreting currencies from Expensify. Expensify cannot 
-# be configured to NOT print currencies out in a locale-specific format!
-# Eventually I will need to make the following a variable, tied to some
-# user-defined parameter
-locale.setlocale(locale.LC_ALL, expensifyLocale)
+""" + str(ExpensifyFormatV1().getExpensifyCategories())
 
 # Helper for finding youngest, oldest dates amongst expenses
 # Used for filling in date range onto sheet
@@ -571,85 +1743,1636 @@ def dateBounds(date, low, high):
 		high = date
 	return low, high
 
-def getExpenseSheetCopy(rb, fnBlankSpreadsheet, fnOutputSpreadsheet):
-	wb = copy(rb) # copy from read-only spreadsheet to output form
+# Bump this whenever recreateFormulas (or anything else baked into the
+# compiled template) changes, so that stale on-disk caches are ignored.
+# The layouts are keyed on separately, by reportLayoutsDigest().
+compiledTemplateVersion = 2
 
-	# get first sheet and verify it's the one we expect,
-	# then instantiate sheet as a ExpenseV3 sheet
-	wbst = wb.get_sheet(0)
-	assert wbst.name == ExpenseV3.v3SheetName
-	xpen = ExpenseV3(wb, wbst, fnOutputSpreadsheet)
-	assert xpen.isEmpty()
+# Turn the read-only template into a pickled, ready-to-fill workbook,
+# pickled again along with the name of its layout and which sheet that
+# layout fills in
+def compileTemplate(rb, fnBlankSpreadsheet):
+	layout, sheetIndex = templateLayout(rb.sheet_names(), fnBlankSpreadsheet)
+	with profiler.timed('xlutilsCopy'):
+		wb = copy(rb) # copy from read-only spreadsheet to output form
+	wbst = wb.get_sheet(sheetIndex)
 
 	# We need to recreate all the formulas. Sigh.
 	# xlutils doesn't have the ability to convert over formulas,
-	# so we have to recreate all of them!
-	xpen.recreateFormulas(formulaWriter)
-
-	return xpen
-
-with open(fnExpensifyDump, 'rb') as fExpensifyDump:
-	outputSheetCounter = 0
-
-	# pull in the expenses from the Expensify csv dump as an iterator
-	expensifyWrapper.initExpensifyDump(fExpensifyDump)
-	expenses = expensifyWrapper.getExpenses()
-
-	# only once, get a read-only copy of the expense sheet from the filename
-	# of the blank spreadsheet
-	rb = xlrd.open_workbook(fnBlankSpreadsheet, formatting_info=True)
-
-	# get an expense sheet copy
-	outputSheetCounter += 1
-	fnOutputSpreadsheet = fnOutputSpreadsheetStem + '-' + \
-		str(outputSheetCounter) + ".xls"
-	xpen = getExpenseSheetCopy(rb, fnBlankSpreadsheet, fnOutputSpreadsheet)
+	# so we have to recreate all of them! At least only once.
+	with profiler.timed('recreateFormulas'):
+		ExpenseV3(wb, wbst, None, None, layout).recreateFormulas(formulaWriter)
+
+	with profiler.timed('templatePickle'):
+		return cPickle.dumps((layout.name, sheetIndex, \
+			cPickle.dumps(wb, cPickle.HIGHEST_PROTOCOL)), \
+			cPickle.HIGHEST_PROTOCOL)
+
+def compiledTemplateCacheName(fnBlankSpreadsheet, cacheDir, backend):
+	h = hashlib.sha1()
+	with open(fnBlankSpreadsheet, 'rb') as fBlankSpreadsheet:
+		h.update(fBlankSpreadsheet.read())
+	h.update('%s:%d:%s' % (reportLayoutsDigest(), compiledTemplateVersion, \
+		backend.version()))
+	return os.path.join(cacheDir, h.hexdigest() + backend.cacheExtension)
+
+def readCompiledTemplate(fnCache):
+	try:
+		with open(fnCache, 'rb') as fCache:
+			return fCache.read()
+	except IOError:
+		return None
+
+def writeCompiledTemplate(fnCache, compiled):
+	# write then rename, so that a concurrent run never sees half a file
+	if not os.path.isdir(os.path.dirname(fnCache)):
+		os.makedirs(os.path.dirname(fnCache))
+	fnTemp = '%s.%d.tmp' % (fnCache, os.getpid())
+	with open(fnTemp, 'wb') as fTemp:
+		fTemp.write(compiled)
+	os.rename(fnTemp, fnCache)
+
+def attachExpenseSheetCopy(compiled, sheetIndex, xpen):
+	loadSpreadsheetModules()
+	# a fresh copy of the form, formulas and all
+	with profiler.timed('templateClone'):
+		wb = cPickle.loads(compiled)
+	xpen.wb = wb
+	xpen.st = wb.get_sheet(sheetIndex)
+
+# Output backends, picked by the template's extension (see outputBackend).
+# Each one compiles the blank form into a string, once (so that it can
+# be kept in a template cache), loads that back as the name of the
+# form's ReportLayout and the form, and gives each packed sheet its own
+# wb and st from the form, along with the cellWriter that
+# ExpenseV3.writeSheet() fills st in with.
+#
+# .xls: xlrd with formatting_info, xlutils copy and xlwt; every sheet is
+# a whole xlwt workbook, unpickled from the compiled one.
+class XlsBackend:
+	extension = '.xls'
+	cacheExtension = '.xlwt'
+
+	def version(self):
+		loadSpreadsheetModules()
+		return xlwt.__VERSION__
+
+	def compile(self, fnBlankSpreadsheet):
+		loadSpreadsheetModules()
+		with profiler.timed('templateRead'):
+			rb = xlrd.open_workbook(fnBlankSpreadsheet, formatting_info=True)
+		return compileTemplate(rb, fnBlankSpreadsheet)
+
+	def sheetNames(self, fnBlankSpreadsheet):
+		loadSpreadsheetModules()
+		rb = xlrd.open_workbook(fnBlankSpreadsheet, on_demand=True)
+		try:
+			return rb.sheet_names()
+		finally:
+			rb.release_resources()
+
+	def load(self, compiled):
+		layoutName, sheetIndex, wbCompiled = cPickle.loads(compiled)
+		return layoutName, (sheetIndex, wbCompiled)
+
+	def attach(self, form, xpen):
+		sheetIndex, wbCompiled = form
+		attachExpenseSheetCopy(wbCompiled, sheetIndex, xpen)
+		xpen.cellWriter = writer
+
+# .xlsx: no spreadsheet modules at all. The form's sheet is split into
+# rows of cells once, and every sheet shares that; saving one streams
+# the rows back out with its own cells patched in, and copies every
+# other part of the template's zip as it was.
+class XlsxBackend:
+	extension = '.xlsx'
+	cacheExtension = '.xlsxform'
+
+	def version(self):
+		return 'xlsx:%d' % xlsxFormVersion
+
+	def compile(self, fnBlankSpreadsheet):
+		with profiler.timed('templateRead'):
+			form = readXlsxForm(fnBlankSpreadsheet)
+		with profiler.timed('recreateFormulas'):
+			ExpenseV3(None, form, None, None, reportLayout(form.layoutName)). \
+				recreateFormulas(xlsxFormulaWriter)
+		with profiler.timed('templatePickle'):
+			return cPickle.dumps(form, cPickle.HIGHEST_PROTOCOL)
+
+	def sheetNames(self, fnBlankSpreadsheet):
+		import zipfile
+		with zipfile.ZipFile(fnBlankSpreadsheet) as zf:
+			return xlsxSheetNames({'xl/workbook.xml':zf.read('xl/workbook.xml')})
+
+	def load(self, compiled):
+		form = cPickle.loads(compiled)
+		return form.layoutName, form
+
+	def attach(self, form, xpen):
+		xpen.wb = XlsxWorkbook(form)
+		xpen.st = xpen.wb.cells
+		xpen.cellWriter = xlsxWriter
+
+outputBackends = {'.xls':XlsBackend(), '.xlsx':XlsxBackend()}
+
+# Anything that isn't .xlsx is taken to be .xls, as it always was
+def outputBackend(fnBlankSpreadsheet):
+	extension = os.path.splitext(fnBlankSpreadsheet)[1].lower()
+	return outputBackends.get(extension, outputBackends['.xls'])
+
+# The layout input_sheet would be filled in with, from the names of its
+# sheets alone, for packing without loading the template
+def inputSheetLayout(fnBlankSpreadsheet):
+	return templateLayout(outputBackend(fnBlankSpreadsheet). \
+		sheetNames(fnBlankSpreadsheet), fnBlankSpreadsheet)[0]
+
+# Bump this whenever readXlsxForm changes what it keeps
+xlsxFormVersion = 2
+
+xlsxSheetDataRe = re.compile(r'<sheetData\s*/>|<sheetData\b[^>]*>(.*?)</sheetData>', \
+	re.S)
+xlsxRowRe = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+xlsxCellRe = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+xlsxRowNumberRe = re.compile(r'\sr="(\d+)"')
+xlsxCellAddressRe = re.compile(r'\sr="([A-Z]+)(\d+)"')
+xlsxStyleRe = re.compile(r'\ss="(\d+)"')
+xlsxSpansRe = re.compile(r'\s(?:r|spans)="[^"]*"')
+# what may follow calcPr in workbook.xml
+xlsxAfterCalcPrRe = re.compile(r'<(?:oleSize|customWorkbookViews|pivotCaches|' \
+	r'smartTagPr|smartTagTypes|webPublishing|fileRecoveryPr|webPublishObjects|' \
+	r'extLst)\b|</workbook>')
+
+# Column letters to a column number counted from 0, as xlwt numbers them
+def xlsxColumnNumber(letters):
+	n = 0
+	for letter in letters:
+		n = n * 26 + ord(letter) - ord('A') + 1
+	return n - 1
+
+def xlsxColumnLetters(col):
+	letters = ''
+	col += 1
+	while col > 0:
+		col, remainder = divmod(col - 1, 26)
+		letters = chr(ord('A') + remainder) + letters
+	return letters
+
+def xlsxEscape(text):
+	return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def xlsxUnescape(text):
+	return text.replace('&lt;', '<').replace('&gt;', '>'). \
+		replace('&quot;', '"').replace('&apos;', "'").replace('&amp;', '&')
+
+# The names of the workbook's sheets, in order
+def xlsxSheetNames(parts):
+	return [xlsxUnescape(re.search(r'\sname="([^"]*)"', sheet).group(1)) \
+		for sheet in re.findall(r'<sheet\b[^>]*>', parts['xl/workbook.xml'])]
+
+# The part of the zip the named sheet is kept in, e.g. xl/worksheets/sheet1.xml
+def xlsxSheetPart(parts, sheetName):
+	workbook = parts['xl/workbook.xml']
+	for sheet in re.findall(r'<sheet\b[^>]*>', workbook):
+		name = re.search(r'\sname="([^"]*)"', sheet)
+		if name == None or xlsxUnescape(name.group(1)) != sheetName:
+			continue
+		rId = re.search(r'\s\w+:id="([^"]*)"', sheet).group(1)
+		for relationship in re.findall(r'<Relationship\b[^>]*>', \
+				parts['xl/_rels/workbook.xml.rels']):
+			if re.search(r'\sId="%s"' % re.escape(rId), relationship):
+				target = re.search(r'\sTarget="([^"]*)"', relationship).group(1)
+				if target.startswith('/'):
+					return target[1:]
+				return 'xl/' + target
+	raise InvalidVersion('No "%s" worksheet available' % sheetName)
+
+# The blank form as an .xlsx: every part of the template but the sheet its
+# layout fills in, as it was, and that sheet as the XML before its rows,
+# the rows, and the XML after. Each row is its <row> attributes and a map
+# of its cells by column, each cell being its style (or None) and its
+# XML. A cell that
+# isn't in the template takes the style of its row, or failing that its
+# column, as it would if it were typed into Excel.
+# Two other parts change: Excel is asked to recalculate the formulas on
+# opening, since none of them come with results, and the calculation
+# chain (which Excel rebuilds) is dropped, since cells that had formulas
+# in the template may not have them any more.
+class XlsxForm:
+	def __init__(self, layoutName, parts, sheetPart, head, rows, tail, \
+			rowStyles, columnStyles):
+		self.layoutName = layoutName
+		self.parts = parts
+		self.sheetPart = sheetPart
+		self.head = head
+		self.rows = rows
+		self.tail = tail
+		self.rowStyles = rowStyles
+		self.columnStyles = columnStyles
+
+	def style(self, row, col):
+		if row in self.rows and col in self.rows[row][1]:
+			return self.rows[row][1][col][0]
+		if row in self.rowStyles:
+			return self.rowStyles[row]
+		return self.columnStyles.get(col)
+
+def readXlsxForm(fnBlankSpreadsheet):
+	import zipfile
+	with zipfile.ZipFile(fnBlankSpreadsheet) as zf:
+		members = [(info, zf.read(info.filename)) for info in zf.infolist()]
+	parts = dict((info.filename, data) for info, data in members)
+	layout, sheetIndex = templateLayout(xlsxSheetNames(parts), \
+		fnBlankSpreadsheet)
+	sheetPart = xlsxSheetPart(parts, layout.sheetName)
+
+	sheet = parts[sheetPart]
+	sheetData = xlsxSheetDataRe.search(sheet)
+	head = sheet[:sheetData.start()] + '<sheetData>'
+	tail = '</sheetData>' + sheet[sheetData.end():]
+	columnStyles = {}
+	for col in re.findall(r'<col\b[^>]*>', head):
+		style = re.search(r'\sstyle="(\d+)"', col)
+		if style != None:
+			for c in range(int(re.search(r'\smin="(\d+)"', col).group(1)) - 1, \
+					int(re.search(r'\smax="(\d+)"', col).group(1))):
+				columnStyles[c] = style.group(1)
+	rows = {}
+	rowStyles = {}
+	rowNumber = 0
+	for rowAttributes, rowCells in xlsxRowRe.findall(sheetData.group(1) or ''):
+		address = xlsxRowNumberRe.search(rowAttributes)
+		rowNumber = int(address.group(1)) if address != None else rowNumber + 1
+		cells = {}
+		col = -1
+		for match in xlsxCellRe.finditer(rowCells):
+			address = xlsxCellAddressRe.search(match.group(1))
+			col = xlsxColumnNumber(address.group(1)) if address != None \
+				else col + 1
+			style = xlsxStyleRe.search(match.group(1))
+			cells[col] = (style.group(1) if style != None else None, \
+				match.group(0))
+		rows[rowNumber - 1] = (xlsxSpansRe.sub('', rowAttributes), cells)
+		if re.search(r'\scustomFormat="(?:1|true)"', rowAttributes):
+			rowStyles[rowNumber - 1] = xlsxStyleRe.search(rowAttributes).group(1)
+
+	workbook = parts['xl/workbook.xml']
+	calcPr = re.search(r'<calcPr\b[^>]*?/?>', workbook)
+	if calcPr == None:
+		at = xlsxAfterCalcPrRe.search(workbook).start()
+		workbook = workbook[:at] + '<calcPr fullCalcOnLoad="1"/>' + workbook[at:]
+	elif 'fullCalcOnLoad' not in calcPr.group(0):
+		workbook = workbook[:calcPr.start()] + \
+			calcPr.group(0).replace('<calcPr', '<calcPr fullCalcOnLoad="1"', 1) \
+			+ workbook[calcPr.end():]
+	parts['xl/workbook.xml'] = workbook
+	parts['[Content_Types].xml'] = re.sub(r'<Override\b[^>]*/calcChain\.xml"[^>]*>', \
+		'', parts['[Content_Types].xml'])
+	parts['xl/_rels/workbook.xml.rels'] = re.sub( \
+		r'<Relationship\b[^>]*Target="[^"]*calcChain\.xml"[^>]*>', '', \
+		parts['xl/_rels/workbook.xml.rels'])
+
+	# the template's own zip entries, in order, keeping their dates so
+	# that the same sheet always makes the same file
+	return XlsxForm(layout.name, [(info.filename, info.date_time, \
+		None if info.filename == sheetPart else parts[info.filename]) \
+		for info, data in members if not info.filename.endswith('calcChain.xml')], \
+		sheetPart, head, rows, tail, rowStyles, columnStyles)
+
+# Marks a formula amongst the values written into an .xlsx sheet
+class XlsxFormula(str):
+	pass
+
+# The cell's XML, keeping the style the template had there
+def xlsxCell(row, col, value, style):
+	address = xlsxColumnLetters(col) + str(row + 1)
+	s = ' s="%s"' % style if style != None else ''
+	if isinstance(value, XlsxFormula):
+		return '<c r="%s"%s><f>%s</f></c>' % (address, s, xlsxEscape(value))
+	if isinstance(value, basestring):
+		return '<c r="%s"%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' \
+			% (address, s, xlsxEscape(value))
+	return '<c r="%s"%s><v>%s</v></c>' % (address, s, \
+		repr(value) if isinstance(value, float) else value)
+
+# Merge (row, col, value, style) cells into a form's rows, giving the rows
+# that changed; the styles that come with the cells are xlwt's, and are
+# ignored for the form's own
+def xlsxPatchedRows(form, cells):
+	patched = {}
+	for r, c, value, style in cells:
+		if r not in patched:
+			attributes, rowCells = form.rows.get(r, ('', {}))
+			patched[r] = (attributes, dict(rowCells))
+		style = form.style(r, c)
+		patched[r][1][c] = (style, xlsxCell(r, c, value, style))
+	return patched
+
+# The cells of the form's formulas, written in by ExpenseV3.recreateFormulas
+def xlsxFormulaWriter(form, cells):
+	form.rows.update(xlsxPatchedRows(form, [(r, c, XlsxFormula(formula), \
+		style) for (r, c, formula, style) in cells]))
+
+# The cellWriter for .xlsx sheets: st is the sheet's list of cells to patch
+# in, which is only done as the sheet is saved
+def xlsxWriter(st, cells):
+	st.extend(cells)
+
+# One .xlsx sheet, filled in from a shared XlsxForm
+class XlsxWorkbook:
+	def __init__(self, form):
+		self.form = form
+		self.cells = []
+
+	# the sheet's XML, a row at a time
+	def sheetXml(self):
+		form = self.form
+		patched = xlsxPatchedRows(form, self.cells)
+		yield form.head
+		for r in sorted(set(form.rows) | set(patched)):
+			attributes, cells = patched[r] if r in patched else form.rows[r]
+			yield '<row r="%d"%s>' % (r + 1, attributes)
+			for c in sorted(cells):
+				yield cells[c][1]
+			yield '</row>'
+		yield form.tail
+
+	# target is a filename or a stream, as for xlwt's Workbook.save
+	def save(self, target):
+		import zipfile
+		zf = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED)
+		try:
+			for name, dateTime, data in self.form.parts:
+				info = zipfile.ZipInfo(name, dateTime)
+				info.compress_type = zipfile.ZIP_DEFLATED
+				info.external_attr = 0600 << 16
+				if data == None:
+					data = ''.join(self.sheetXml())
+				zf.writestr(info, data)
+		finally:
+			zf.close()
+
+# Either the target and source currencies are identical, OR
+# Expensify should have done a conversion--otherwise Expensify
+# was set up wrong!
+def checkCurrency(exp, homeCurrency):
+	if homeCurrency == exp.origCurrency:
+		if exp.amount != exp.origAmount:
+			explanation = ("Check your default currency in "
+					"Expensify, and compare to the "
+					"currency you're specifying. "
+					"Output currency %s and Expensify "
+					"currency %s match, but amounts "
+					"%.2f and %.2f are different" %
+					(homeCurrency, exp.origCurrency,
+					exp.amount, exp.origAmount))
+			raise InvalidCSVCurrency(explanation)
+	elif exp.amount == exp.origAmount:
+			explanation = ("Check your default currency in "
+					"Expensify, and compare to the "
+					"currency you're specifying. "
+					"Output currency %s and Expensify "
+					"currency %s differ, but amounts "
+					"%.2f and %.2f are the same" %
+					(homeCurrency, exp.origCurrency,
+					exp.amount, exp.origAmount))
+			raise InvalidCSVCurrency(explanation)
+
+def outputSpreadsheetName(fnOutputSpreadsheetStem, outputSheetCounter, \
+		extension = '.xls'):
+	return fnOutputSpreadsheetStem + '-' + str(outputSheetCounter) + extension
+
+# Pack a stream of expenses into as many ExpenseV3 sheets as it takes.
+# Each sheet is handed back as soon as it is full, before it has a
+# workbook of its own, so that the caller decides where it gets saved.
+# The sheets' sections are as long as layout has them (by default, the
+# V3 layout's), and their names end in the extension of the backend
+# they'll be saved with.
+def packExpenses(expenses, config, fnOutputSpreadsheetStem, options = None, \
+		layout = None, extension = '.xls'):
+	if layout == None:
+		layout = reportLayout(defaultLayoutName)
+	if options != None and options.packing == 'optimal':
+		return packExpensesOptimal(expenses, config, fnOutputSpreadsheetStem, \
+			layout, extension)
+	return packExpensesGreedy(expenses, config, fnOutputSpreadsheetStem, \
+		layout, extension)
+
+# Fill sheets in file order, starting a new one whenever any section
+# overflows. Streams, but an unsorted dump can take many more sheets
+# than it needs.
+def packExpensesGreedy(expenses, config, fnOutputSpreadsheetStem, layout, \
+		extension):
+	combine = profiler.wrap('combine', ExpenseV3.combine)
+	outputSheetCounter = 1
+	xpen = ExpenseV3(None, None, outputSpreadsheetName( \
+		fnOutputSpreadsheetStem, outputSheetCounter, extension), config, layout)
+	profiler.count('sheetsCreated')
 
 	# process each expense one by one
 	for exp in expenses:
-		# Either the target and source currencies are identical, OR
-		# Expensify should have done a conversion--otherwise Expensify
-		# was set up wrong!
-		if homeCurrency == exp.origCurrency:
-			if exp.amount != exp.origAmount:
-				explanation = ("Check your default currency in "
-						"Expensify, and compare to the "
-						"currency you're specifying. "
-						"Output currency %s and Expensify "
-						"currency %s match, but amounts "
-						"%.2f and %.2f are different" %
-						(homeCurrency, exp.origCurrency,
-						exp.amount, exp.origAmount))
-				raise InvalidCSVCurrency(explanation)
-		elif exp.amount == exp.origAmount:
-				explanation = ("Check your default currency in "
-						"Expensify, and compare to the "
-						"currency you're specifying. "
-						"Output currency %s and Expensify "
-						"currency %s differ, but amounts "
-						"%.2f and %.2f are the same" %
-						(homeCurrency, exp.origCurrency,
-						exp.amount, exp.origAmount))
-				raise InvalidCSVCurrency(explanation)
-
-
 		try:
-			xpen.combine(exp)
+			combine(xpen, exp)
 		except OverflowException:
 			# if we couldn't fit in the expense, start a new sheet
 			assert not xpen.isEmpty()
-			xpen.save()
+			profiler.count('overflows')
+			yield xpen
 
 			outputSheetCounter += 1
-			fnOutputSpreadsheet = fnOutputSpreadsheetStem + '-' + \
-				str(outputSheetCounter) + ".xls"
-			xpen = getExpenseSheetCopy(rb, fnBlankSpreadsheet, \
-				fnOutputSpreadsheet)
+			profiler.count('sheetsCreated')
+			xpen = ExpenseV3(None, None, \
+				outputSpreadsheetName(fnOutputSpreadsheetStem, \
+				outputSheetCounter, extension), config, layout)
 			# Don't forget to add that expense to the new sheet!
 			assert xpen.isEmpty()
 			xpen.combine(exp)
+
+	# nothing at all to report is fine, e.g. with --since-last-run
+	if not xpen.isEmpty():
+		yield xpen
+
+# Use as few sheets as possible. Each section of the form fills up on its
+# own (travel by date, entertainment and miscellaneous by entry), so the
+# fewest sheets we can get away with is the most that any one section
+# needs. Dealing each section's entries out in date order, a full section
+# per sheet, gets exactly that. It does mean seeing every expense before
+# the first sheet is done, so the whole dump is held in memory.
+#
+# The currency cost line still fits: a sheet with travel dates on it gets
+# one of them as anyDate, and a sheet without has an empty travel section.
+def packExpensesOptimal(expenses, config, fnOutputSpreadsheetStem, layout, \
+		extension):
+	travelByDate = collections.defaultdict(list)
+	entertainmentExp = []
+	miscellaneousExp = []
+	for exp in expenses:
+		if exp.expenseType == 'entertainment':
+			entertainmentExp.append([exp])
+		elif exp.expenseType == 'miscellaneous':
+			miscellaneousExp.append([exp])
+		else:
+			travelByDate[exp.date].append(exp)
+	travelExp = [travelByDate[d] for d in sorted(travelByDate.keys())]
+	entertainmentExp.sort(key = lambda entry: entry[0].date)
+	miscellaneousExp.sort(key = lambda entry: entry[0].date)
+
+	sections = [(travelExp, layout.travel.rows), \
+		(entertainmentExp, layout.entertainment.rows), \
+		(miscellaneousExp, layout.miscellaneous.rows)]
+	sheetCount = max([(len(entries) + maxEntries - 1) / maxEntries \
+		for (entries, maxEntries) in sections])
+
+	combine = profiler.wrap('combine', ExpenseV3.combine)
+	for i in range(sheetCount):
+		xpen = ExpenseV3(None, None, \
+			outputSpreadsheetName(fnOutputSpreadsheetStem, i + 1, extension), \
+			config, layout)
+		profiler.count('sheetsCreated')
+		sheetExp = []
+		for entries, maxEntries in sections:
+			for entry in entries[i * maxEntries:(i + 1) * maxEntries]:
+				sheetExp.extend(entry)
+		sheetExp.sort(key = lambda exp: exp.date)
+		for exp in sheetExp:
+			combine(xpen, exp)
+		yield xpen
+
+# A zip file that sheets are saved straight into, instead of each to a
+# <stem>-N.xls file of its own. A sheet is stored under its file's name
+# without the directory, unless another report's sheet already took
+# that name, in which case the directory is kept.
+class SheetArchive:
+	def __init__(self, fnArchive):
+		import zipfile
+		self.fnArchive = fnArchive
+		self.zip = zipfile.ZipFile(fnArchive, 'w', zipfile.ZIP_DEFLATED)
+		self.names = set()
+
+	def memberName(self, fnOutputSpreadsheet):
+		name = os.path.basename(fnOutputSpreadsheet)
+		if name in self.names:
+			name = '/'.join(part for part in \
+				os.path.normpath(fnOutputSpreadsheet).split(os.sep) \
+				if part not in ('', '.', '..'))
+		return name
+
+	# Store an already-saved sheet; returns the name it's stored under
+	def write(self, fnOutputSpreadsheet, data):
+		name = self.memberName(fnOutputSpreadsheet)
+		self.names.add(name)
+		print "Saving to %s in %s" % (name, self.fnArchive)
+		self.zip.writestr(name, data)
+		return name
+
+	def add(self, xpen):
+		return self.write(xpen.fnOutputSpreadsheet, xpen.saveBytes())
+
+	def close(self):
+		self.zip.close()
+
+# Save a sheet that already has its copy of the form: to its own file,
+# or into archive if there is one. Returns where it went.
+def saveSheet(xpen, archive = None):
+	if archive != None:
+		return archive.add(xpen)
+	xpen.save()
+	return xpen.fnOutputSpreadsheet
+
+# Pack a stream of expenses into as many copies of the template as it
+# takes, saving each one as it fills up (see saveSheet). Returns the
+# filenames, or archive names, written.
+def convertExpenses(expenses, template, config, fnOutputSpreadsheetStem, \
+		options = None, archive = None):
+	if options != None and options.pipeline:
+		return convertExpensesPipelined(expenses, template, config, \
+			fnOutputSpreadsheetStem, options, archive)
+	fnOutputSheets = []
+	for xpen in packExpenses(expenses, config, fnOutputSpreadsheetStem, \
+			options, template.layout, template.backend.extension):
+		template.attachExpenseSheetCopy(xpen)
+		fnOutputSheets.append(saveSheet(xpen, archive))
+	return fnOutputSheets
+
+# Saves sheets on a thread of its own, in the order they are put(), so
+# that the next sheet is parsed and packed while the last one is being
+# written. At most queueSize sheets wait their turn; put() blocks
+# beyond that, so a slow disk can't make us hold the whole dump.
+# Once a save fails, the rest are skipped, and the error is raised
+# again, traceback and all, from the next put() or from finish().
+class BackgroundSheetWriter:
+	def __init__(self, template, archive = None, queueSize = 4):
+		import threading, Queue
+		self.template = template
+		self.archive = archive
+		self.queue = Queue.Queue(queueSize)
+		self.fnOutputSheets = []
+		self.error = None
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			xpen = self.queue.get()
+			if xpen is None:
+				return
+			if self.error != None:
+				continue
+			try:
+				self.template.attachExpenseSheetCopy(xpen)
+				self.fnOutputSheets.append(saveSheet(xpen, self.archive))
+			except Exception:
+				self.error = sys.exc_info()
+
+	def raiseError(self):
+		if self.error != None:
+			raise self.error[0], self.error[1], self.error[2]
+
+	def put(self, xpen):
+		self.raiseError()
+		self.queue.put(xpen)
+
+	# Wait for every sheet already put() to be saved
+	def stop(self):
+		self.queue.put(None)
+		self.thread.join()
+
+	def finish(self):
+		self.stop()
+		self.raiseError()
+		return self.fnOutputSheets
+
+# convertExpenses, with the saving done by a BackgroundSheetWriter. The
+# same sheets come out in the same order. If reading the dump fails,
+# the sheets packed before that are still saved, as they would have been
+# without the pipeline, and then the reading error is raised.
+def convertExpensesPipelined(expenses, template, config, \
+		fnOutputSpreadsheetStem, options, archive = None):
+	sheetWriter = BackgroundSheetWriter(template, archive)
+	try:
+		for xpen in packExpenses(expenses, config, fnOutputSpreadsheetStem, \
+				options, template.layout, template.backend.extension):
+			sheetWriter.put(xpen)
+	except:
+		sheetWriter.stop()
+		raise
+	return sheetWriter.finish()
+
+# Pull in the expenses from an Expensify csv dump as an iterator,
+# already checked against the currency we're reporting in
+def readExpensifyDump(fnExpensifyDump, config, options = None, \
+		rowFilter = None):
+	if options == None:
+		options = ConvertOptions()
+
+	with open(fnExpensifyDump, 'rb') as fExpensifyDump:
+		if options.ingestJobs > 1:
+			wrapper = ExpensifyChunkedFormatV1(options.ingestJobs)
+		elif options.columnar:
+			wrapper = ExpensifyColumnarFormatV1()
+		else:
+			wrapper = ExpensifyFormatV1()
+		# ESSENTIAL for interpreting currencies from Expensify. Expensify
+		# cannot be configured to NOT print currencies out in a
+		# locale-specific format!
+		wrapper.setAmountLocale(config.expensifyLocale)
+		wrapper.rowFilter = rowFilter
+		wrapper.initExpensifyDump(fExpensifyDump)
+		for exp in wrapper.getCheckedExpenses(config.homeCurrency):
+			yield exp
+
+# Check a whole dump, or a report's list of dumps, in one pass, without
+# stopping at the first bad row. Returns a (dump, line, field, message)
+# for everything wrong; line is where the row ends in the file, as the
+# csv module counts lines. A row that the csv module can't read stops
+# the check of that dump, since there's no telling where the next starts.
+def validateDump(fnExpensifyDump, config):
+	problems = []
+	for fn in expensifyDumps(fnExpensifyDump):
+		with open(fn, 'rb') as fExpensifyDump:
+			wrapper = ExpensifyFormatV1()
+			wrapper.setAmountLocale(config.expensifyLocale)
+			wrapper.initExpensifyDump(fExpensifyDump)
+			try:
+				for exp in wrapper.rdr:
+					for field, message in wrapper.validateExpense(exp, \
+							config.homeCurrency):
+						problems.append((fn, wrapper.rdr.line_num, field, \
+							message))
+			except csv.Error as ex:
+				problems.append((fn, wrapper.rdr.line_num, None, str(ex)))
+	return problems
+
+# Several dumps of one person's expenses (one per card, say) read as a
+# single stream, for a single packing pass. Expensify writes each dump
+# in timestamp order, so a k-way merge on the date keeps the stream in
+# order without reading any dump ahead of the others. Expenses on the
+# same date come in dump order, then row order. rowFilters, if given,
+# has one rowFilter per dump.
+def readExpensifyDumps(fnExpensifyDumps, config, options = None, \
+		rowFilters = None):
+	if rowFilters == None:
+		rowFilters = [None] * len(fnExpensifyDumps)
+	if len(fnExpensifyDumps) == 1:
+		return readExpensifyDump(fnExpensifyDumps[0], config, options, \
+			rowFilters[0])
+	streams = [datedExpenses(i, readExpensifyDump(fnExpensifyDump, config, \
+		options, rowFilter)) for (i, (fnExpensifyDump, rowFilter)) in \
+		enumerate(zip(fnExpensifyDumps, rowFilters))]
+	return (exp for (date, i, row, exp) in heapq.merge(*streams))
+
+# heapq.merge has no key, so each expense goes in a tuple that sorts
+# the way we want
+def datedExpenses(dumpIndex, expenses):
+	for row, exp in enumerate(expenses):
+		yield exp.date, dumpIndex, row, exp
+
+# A report's dump can be one filename, or a list of them to be merged
+def expensifyDumps(dump):
+	if isinstance(dump, basestring):
+		return [dump]
+	return list(dump)
+
+# Row filters for reading a report's dumps with a ProcessedExpenseIndex
+# (or None without one), all adding to the same newFingerprints
+def indexRowFilters(index, name, fnExpensifyDumps, newFingerprints):
+	if index == None:
+		return None
+	return [index.rowFilter(name, newFingerprints) \
+		for fnExpensifyDump in fnExpensifyDumps]
+
+# Sheets are named after the (first) dump
+def outputSpreadsheetStem(dump):
+	return os.path.splitext(expensifyDumps(dump)[0])[0]
+
+# Convert one Expensify dump, or a list of one person's dumps merged
+# together (see readExpensifyDumps). template may be the filename of the
+# blank expense form, or an ExpenseTemplate that has already been loaded.
+# Output sheets go next to the (first) dump unless a stem is given.
+# With a ProcessedExpenseIndex, only rows that aren't in it are reported,
+# and they are added to it once their sheets have been saved.
+# With a SheetArchive, the sheets are saved into that instead.
+# With an ExpenseHistory, duplicates (see options.duplicates) are looked
+# for there too, and what's reported is added to it. batchRecords, the
+# records of this person's earlier reports in a batch, are looked in and
+# added to the same way.
+def convertDump(fnExpensifyDump, template, config, \
+		fnOutputSpreadsheetStem = None, options = None, index = None, \
+		archive = None, history = None, batchRecords = None):
+	if not isinstance(template, ExpenseTemplate):
+		template = ExpenseTemplate(template)
+	if fnOutputSpreadsheetStem == None:
+		fnOutputSpreadsheetStem = outputSpreadsheetStem(fnExpensifyDump)
+	fnExpensifyDumps = expensifyDumps(fnExpensifyDump)
+	newFingerprints = []
+	newRecords = []
+	rowFilters = indexRowFilters(index, config.yourName, fnExpensifyDumps, \
+		newFingerprints)
+	fnOutputSheets = convertExpenses(duplicateChecked( \
+		readExpensifyDumps(fnExpensifyDumps, config, options, rowFilters), \
+		config, options, history, newRecords, batchRecords), \
+		template, config, fnOutputSpreadsheetStem, options, archive)
+	if index != None:
+		index.add(newFingerprints)
+	if history != None:
+		history.add(config.yourName, newRecords)
+	if batchRecords != None:
+		batchRecords.extend(newRecords)
+	return fnOutputSheets
+
+# Library entry point: convert one person's dump, e.g.
+#   convert('dump.csv', 'expense-form.xls', 'Fred Astaire', 'EUR', 2.5, 'de_DE')
+def convert(dump, template, name, currency = 'USD', uplift = 0.0, \
+		locale = 'en_US'):
+	return convertDump(dump, template, \
+		ReportConfig(name, currency, uplift, locale))
+
+# Manifest is a CSV file of (name, expensify_dump) pairs. A line can
+# list more than one dump, to be merged into one report, and can end
+# with an input_sheet of its own (anything not ending in .csv) to fill in
+# instead of the batch's, as a third item.
+def readManifest(fnManifest):
+	manifest = []
+	with open(fnManifest, 'rb') as fManifest:
+		for row in csv.reader(fManifest):
+			if len(row) == 0:
+				continue
+			dumps = row[1:]
+			fnBlankSpreadsheet = None
+			if len(dumps) > 1 and os.path.splitext(dumps[-1])[1] != ".csv":
+				fnBlankSpreadsheet = dumps.pop()
+			dump = dumps[0] if len(dumps) == 1 else dumps
+			if fnBlankSpreadsheet == None:
+				manifest.append((row[0], dump))
+			else:
+				manifest.append((row[0], dump, fnBlankSpreadsheet))
+	return manifest
+
+# A manifest line as (name, dump, input_sheet), input_sheet being None
+# if it doesn't have one of its own
+def manifestEntry(entry):
+	if len(entry) > 2:
+		return entry
+	return entry[0], entry[1], None
+
+# A company-wide export has every employee's expenses in one CSV, with a
+# column saying whose each row is. Sharding splits it, in one pass, into
+# an ordinary dump per employee and period (the period being how much of
+# the Timestamp is kept, e.g. 2015-03 for a month), each of which is then
+# converted as a report of its own. Rows are copied as they are, header
+# and all, without being converted, and keep the order they had.
+shardPeriods = {'month':7, 'year':4, 'all':0}
+
+# Splits rows up into their shards' dumps. Rows are held in memory until
+# bufferRows are waiting; an export that fits in that is written straight
+# to its dumps, each in one go. Beyond that, the rows waiting are spilled
+# to spillFiles temporary files, each shard always to the same one, so
+# that only that many files are ever open however many shards there are.
+# Once the export is all read, the spill files are read back one at a
+# time, each holding the rows of only some of the shards, and those are
+# written out to their dumps, again each in one go.
+class ShardWriter:
+	def __init__(self, dirShards, header, bufferRows, spillFiles = 256):
+		self.dirShards = dirShards
+		self.header = header
+		self.bufferRows = bufferRows
+		self.spillFiles = spillFiles
+		self.buffers = {}
+		self.buffered = 0
+		self.spills = None
+		self.fnShards = {}
+		self.names = set()
+
+	# The shard's dump, named after the employee and period, with
+	# anything that isn't safe in a filename replaced
+	def shardFilename(self, employee, period):
+		name = re.sub(r'[^\w.@+-]', '_', employee) or '_'
+		if period != '':
+			name += '-' + period
+		stem = name
+		counter = 1
+		while name.lower() in self.names:
+			counter += 1
+			name = '%s~%d' % (stem, counter)
+		self.names.add(name.lower())
+		return os.path.join(self.dirShards, name + '.csv')
+
+	def add(self, key, row):
+		if key in self.buffers:
+			self.buffers[key].append(row)
+		else:
+			self.buffers[key] = [row]
+		self.buffered += 1
+		if self.buffered >= self.bufferRows:
+			self.spill()
+
+	# Each spilled row has its shard's employee and period in front
+	def spill(self):
+		import tempfile
+		with profiler.timed('shardSpill'):
+			if self.spills == None:
+				self.dirSpill = tempfile.mkdtemp(prefix = '.spill', \
+					dir = self.dirShards)
+				self.spills = [open(os.path.join(self.dirSpill, '%d.csv' % i), \
+					'w+b') for i in range(self.spillFiles)]
+				self.spillWriters = [csv.writer(fSpill) for fSpill in self.spills]
+			for key, rows in self.buffers.iteritems():
+				self.spillWriters[hash(key) % self.spillFiles].writerows( \
+					[key + tuple(row) for row in rows])
+			profiler.count('shardSpills')
+		self.buffers = {}
+		self.buffered = 0
+
+	# Write out the buffered shards; a dump left over from an earlier run
+	# is replaced
+	def writeShards(self, buffers):
+		with profiler.timed('shardWrite'):
+			for key, rows in buffers.iteritems():
+				self.fnShards[key] = self.shardFilename(*key)
+				with open(self.fnShards[key], 'wb') as fShard:
+					writer = csv.writer(fShard)
+					writer.writerow(self.header)
+					writer.writerows(rows)
+
+	def removeSpills(self):
+		import shutil
+		if self.spills != None:
+			for fSpill in self.spills:
+				fSpill.close()
+			shutil.rmtree(self.dirSpill)
+			self.spills = None
+
+	# The (employee, dump) of every shard, in order of employee then period
+	def close(self):
+		if self.spills == None:
+			self.writeShards(self.buffers)
+		else:
+			self.spill()
+			try:
+				for fSpill in self.spills:
+					fSpill.seek(0)
+					buffers = {}
+					for row in csv.reader(fSpill):
+						key = (row[0], row[1])
+						if key in buffers:
+							buffers[key].append(row[2:])
+						else:
+							buffers[key] = [row[2:]]
+					self.writeShards(buffers)
+			finally:
+				self.removeSpills()
+		return [(employee, self.fnShards[(employee, period)]) \
+			for (employee, period) in sorted(self.fnShards)]
+
+# Shard fnExport into dirShards, giving a manifest of (employee, dump)
+# to convert; see convertBatch. employeeColumn is the export's column
+# saying whose each row is.
+def shardExport(fnExport, dirShards, employeeColumn = 'Employee', \
+		period = 'month', bufferRows = 100000):
+	periodLength = shardPeriods[period]
+	if not os.path.isdir(dirShards):
+		os.makedirs(dirShards)
+	with open(fnExport, 'rb') as fExport:
+		rdr = csv.reader(fExport)
+		header = next(rdr, [])
+		for column in employeeColumn, 'Timestamp':
+			if column not in header:
+				raise InvalidVersion('No "%s" column in %s' % (column, fnExport))
+		employeeIndex = header.index(employeeColumn)
+		timestampIndex = header.index('Timestamp')
+		writer = ShardWriter(dirShards, header, bufferRows)
+		try:
+			for row in profiler.timedIterator('shardRead', rdr, 'rowsSharded'):
+				if len(row) == 0:
+					continue
+				try:
+					key = (row[employeeIndex], row[timestampIndex][:periodLength])
+				except IndexError:
+					# short rows are passed on for converting to complain about
+					key = (row[employeeIndex] if employeeIndex < len(row) \
+						else '', '')
+				writer.add(key, row)
 		except:
+			writer.removeSpills()
 			raise
+	return writer.close()
+
+# Templates already loaded in this process, by filename. Filled in before
+# the pool forks so that workers normally inherit a loaded template.
+workerTemplates = {}
+
+# The templates a batch fills in, by filename: the batch's own, and each
+# one that lines of the manifest name instead, loaded once however many
+# name it, and cached alongside the batch's. One that won't load is kept
+# as the error, for the reports that name it to fail with.
+def batchTemplates(manifest, template):
+	templates = {template.fnBlankSpreadsheet:template}
+	for name, dump, fnBlankSpreadsheet in map(manifestEntry, manifest):
+		if fnBlankSpreadsheet != None and fnBlankSpreadsheet not in templates:
+			try:
+				templates[fnBlankSpreadsheet] = \
+					ExpenseTemplate(fnBlankSpreadsheet, template.cacheDir)
+			except Exception as ex:
+				templates[fnBlankSpreadsheet] = ex
+	return templates
+
+def lineTemplate(templates, template, fnBlankSpreadsheet):
+	if fnBlankSpreadsheet == None:
+		return template
+	if isinstance(templates[fnBlankSpreadsheet], Exception):
+		raise templates[fnBlankSpreadsheet]
+	return templates[fnBlankSpreadsheet]
+
+def getWorkerTemplate(fnBlankSpreadsheet):
+	if fnBlankSpreadsheet not in workerTemplates:
+		workerTemplates[fnBlankSpreadsheet] = \
+			ExpenseTemplate(fnBlankSpreadsheet)
+	return workerTemplates[fnBlankSpreadsheet]
+
+# Runs in a pool worker: copy the form for a packed sheet and save it,
+# or if it's going into an archive, hand back its bytes for the parent
+# to store. Returns the filename, the bytes (or None) and what the
+# profiler recorded doing it.
+def saveExpenseSheet(fnBlankSpreadsheet, xpen, toArchive = False):
+	getWorkerTemplate(fnBlankSpreadsheet).attachExpenseSheetCopy(xpen)
+	data = None
+	if toArchive:
+		data = xpen.saveBytes()
+	else:
+		xpen.save()
+	return xpen.fnOutputSpreadsheet, data, profiler.drain()
+
+# Take one sheet back from the pool, in the order they were handed out:
+# store it in the archive if it's going into one, and add its filename
+# to its report's, or what went wrong saving it to its report's errors
+def collectExpenseSheet(archive, sheet, fnOutputSheets, errors):
+	try:
+		fnOutputSheet, data, profile = sheet.get()
+		if data != None:
+			fnOutputSheet = archive.write(fnOutputSheet, data)
+		fnOutputSheets.append(fnOutputSheet)
+		profiler.merge(profile)
+	except Exception as ex:
+		errors.append(ex)
+
+# Parse and pack every dump here, but copy, fill and save the sheets in
+# the pool. Packing is cheap next to the workbook copy and save, and
+# doing it in one place keeps the -N.xls numbering deterministic.
+# The index and history are only written to once a report's sheets are
+# saved, but a later report for the same person has to see what the
+# earlier ones took, as it does converting one report at a time: so
+# each report's rows are skipped in the index, and its records added to
+# batchRecords, as soon as it is packed.
+# Sheets are taken back as the workers finish them, while later ones are
+# still being packed, so that only about jobs * 4 are ever waiting (with
+# their bytes, when they go into an archive).
+def convertBatchParallel(manifest, templates, template, configs, options, \
+		index, archive, history, batchRecords):
+	import multiprocessing
+	jobs = options.jobs
+	workerTemplates.update((fnBlankSpreadsheet, loaded) \
+		for (fnBlankSpreadsheet, loaded) in templates.items() \
+		if isinstance(loaded, ExpenseTemplate))
+	pool = multiprocessing.Pool(jobs, resetWorkerProfiler)
+	try:
+		pending = []
+		outstanding = collections.deque()
+		for (name, dump, fnBlankSpreadsheet), config in \
+				zip(map(manifestEntry, manifest), configs):
+			fnOutputSheets = []
+			sheetErrors = []
+			error = None
+			newFingerprints = []
+			newRecords = []
+			fnExpensifyDumps = expensifyDumps(dump)
+			rowFilters = indexRowFilters(index, name, fnExpensifyDumps, \
+				newFingerprints)
+			try:
+				reportTemplate = lineTemplate(templates, template, \
+					fnBlankSpreadsheet)
+				for xpen in packExpenses(duplicateChecked( \
+						readExpensifyDumps(fnExpensifyDumps, config, \
+						options, rowFilters), \
+						config, options, history, newRecords, \
+						batchRecords[config.yourName]), \
+						config, outputSpreadsheetStem(dump), options, \
+						reportTemplate.layout, \
+						reportTemplate.backend.extension):
+					# don't run too far ahead of the workers
+					while len(outstanding) >= jobs * 4:
+						collectExpenseSheet(archive, *outstanding.popleft())
+					sheet = pool.apply_async(saveExpenseSheet, \
+						(reportTemplate.fnBlankSpreadsheet, xpen, \
+						archive != None))
+					outstanding.append((sheet, fnOutputSheets, sheetErrors))
+			except Exception as ex:
+				error = ex
+			if error == None and index != None:
+				index.skip(newFingerprints)
+			if error == None:
+				batchRecords[config.yourName].extend(newRecords)
+			pending.append((name, dump, fnOutputSheets, sheetErrors, error, \
+				newFingerprints, newRecords))
+		while len(outstanding) > 0:
+			collectExpenseSheet(archive, *outstanding.popleft())
+
+		results = []
+		for name, dump, fnOutputSheets, sheetErrors, error, newFingerprints, \
+				newRecords in pending:
+			if error == None and len(sheetErrors) > 0:
+				error = sheetErrors[0]
+			if error == None and index != None:
+				index.add(newFingerprints)
+			if error == None and history != None:
+				history.add(name, newRecords)
+			results.append((name, dump, fnOutputSheets, error))
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	return results
+
+# Convert many people's dumps against a template that is only loaded once,
+# as is any other that a line of the manifest names for itself.
+# One bad dump doesn't stop the rest: returns a list of
+# (name, dump, output filenames, error) tuples, error being None on success.
+def convertBatch(manifest, template, currency = 'USD', uplift = 0.0, \
+		locale = 'en_US', options = None):
+	if not isinstance(template, ExpenseTemplate):
+		template = ExpenseTemplate(template)
+	if options == None:
+		options = ConvertOptions()
+	templates = batchTemplates(manifest, template)
+	configs = [ReportConfig(entry[0], currency, uplift, locale) \
+		for entry in manifest]
+	index = None
+	if options.sinceLastRun != None:
+		index = ProcessedExpenseIndex(options.sinceLastRun)
+	archive = None
+	if options.archive != None:
+		archive = SheetArchive(options.archive)
+	history = None
+	if options.duplicateHistory != None:
+		history = ExpenseHistory(options.duplicateHistory)
+	# each person's records so far, whether or not there's a history
+	batchRecords = collections.defaultdict(list)
+
+	try:
+		if options.jobs > 1:
+			return convertBatchParallel(manifest, templates, template, \
+				configs, options, index, archive, history, batchRecords)
+
+		results = []
+		for (name, dump, fnBlankSpreadsheet), config in \
+				zip(map(manifestEntry, manifest), configs):
+			try:
+				results.append((name, dump, convertDump(dump, \
+					lineTemplate(templates, template, fnBlankSpreadsheet), \
+					config, None, options, index, archive, history, \
+					batchRecords[config.yourName]), None))
+			except Exception as ex:
+				results.append((name, dump, [], ex))
+		return results
+	finally:
+		if history != None:
+			history.close()
+		if archive != None:
+			archive.close()
+		if index != None:
+			index.close()
+
+# Everything a conversion does short of touching a spreadsheet: parse,
+# check and pack the dump for layout (by default, the V3 layout), then
+# describe the sheets that would come out, named with extension as an
+# input_sheet of that type would have them. Never imports xlrd or xlwt.
+# An index or history, if given, is only read from; batchRecords are
+# looked in and added to as convertDump() does.
+def summarizeDump(fnExpensifyDump, config, options = None, index = None, \
+		history = None, layout = None, batchRecords = None, \
+		extension = '.xls'):
+	fnExpensifyDumps = expensifyDumps(fnExpensifyDump)
+	rowFilters = indexRowFilters(index, config.yourName, fnExpensifyDumps, [])
+	newRecords = []
+	sheets = []
+	low = None
+	high = None
+	for xpen in packExpenses(duplicateChecked( \
+			readExpensifyDumps(fnExpensifyDumps, config, options, rowFilters), \
+			config, options, history, newRecords, batchRecords), \
+			config, outputSpreadsheetStem(fnExpensifyDump), options, layout, \
+			extension):
+		sheets.append(xpen.summarize())
+		low, high = dateBounds(xpen.low, low, high)
+		low, high = dateBounds(xpen.high, low, high)
+	if batchRecords != None:
+		batchRecords.extend(newRecords)
+	return { \
+		'name':config.yourName, \
+		'dump':fnExpensifyDump, \
+		'currency':config.homeCurrency, \
+		'sheets':sheets, \
+		'low':str(low) if low != None else None, \
+		'high':str(high) if high != None else None, \
+		'currencyCost':round(sum(sheet['currencyCost'] for sheet in sheets), 2), \
+		'total':round(sum(sheet['total'] for sheet in sheets), 2), \
+		'error':None \
+	}
 
-	assert not xpen.isEmpty()
-	xpen.save()
+# Dry run over a batch: one summarizeDump() dict per report, with the
+# error filled in for any report that fails. Each report is packed for
+# the layout of the line's own input_sheet if it has one, and its sheets
+# named for that input_sheet's type; otherwise for layout and extension.
+# Only the names of those sheets are read, with xlrd for an .xls one.
+def summarizeBatch(manifest, currency = 'USD', uplift = 0.0, \
+		locale = 'en_US', options = None, layout = None, extension = '.xls'):
+	index = None
+	if options != None and options.sinceLastRun != None:
+		index = ProcessedExpenseIndex(options.sinceLastRun)
+	history = None
+	if options != None and options.duplicateHistory != None:
+		history = ExpenseHistory(options.duplicateHistory)
+	batchRecords = collections.defaultdict(list)
+	try:
+		summaries = []
+		layouts = {}
+		for name, dump, fnBlankSpreadsheet in map(manifestEntry, manifest):
+			config = ReportConfig(name, currency, uplift, locale)
+			try:
+				lineLayout = layout
+				lineExtension = extension
+				if fnBlankSpreadsheet != None:
+					if fnBlankSpreadsheet not in layouts:
+						layouts[fnBlankSpreadsheet] = \
+							inputSheetLayout(fnBlankSpreadsheet)
+					lineLayout = layouts[fnBlankSpreadsheet]
+					lineExtension = outputBackend(fnBlankSpreadsheet).extension
+				summaries.append(summarizeDump(dump, config, options, index, \
+					history, lineLayout, batchRecords[name], lineExtension))
+			except Exception as ex:
+				summaries.append({'name':name, 'dump':dump, \
+					'error':'%s: %s' % (type(ex).__name__, str(ex))})
+		return summaries
+	finally:
+		if history != None:
+			history.close()
+		if index != None:
+			index.close()
+
+# Runs in a service worker: convert one uploaded dump (its bytes) with a
+# template the worker already has loaded, and hand back the sheet names
+# and a zip of the sheets. The dump and sheets only touch disk in a
+# directory of the worker's own, which is gone again afterwards.
+def convertUpload(fnBlankSpreadsheet, data, fnDump, config, options):
+	import shutil, tempfile
+	dirUpload = tempfile.mkdtemp(prefix = 'expensifier-')
+	try:
+		fnExpensifyDump = os.path.join(dirUpload, fnDump)
+		with open(fnExpensifyDump, 'wb') as fExpensifyDump:
+			fExpensifyDump.write(data)
+		fnArchive = os.path.join(dirUpload, 'sheets.zip')
+		archive = SheetArchive(fnArchive)
+		try:
+			fnOutputSheets = convertDump(fnExpensifyDump, \
+				getWorkerTemplate(fnBlankSpreadsheet), config, None, options, \
+				None, archive)
+		finally:
+			archive.close()
+		with open(fnArchive, 'rb') as fArchive:
+			return fnOutputSheets, fArchive.read()
+	finally:
+		shutil.rmtree(dirUpload)
+
+# Workers leave ^C to the server, which closes the pool itself
+def resetServiceWorker():
+	import signal
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	resetWorkerProfiler()
+
+# Request counts and latencies for the conversion service. Latency
+# percentiles are over the last window requests; rates are since start.
+class ServiceMetrics:
+	def __init__(self, window = 1000):
+		import threading
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.requests = 0
+		self.failures = 0
+		self.inFlight = 0
+		self.sheets = 0
+		self.bytesIn = 0
+		self.bytesOut = 0
+		self.latencies = collections.deque(maxlen = window)
+
+	def begin(self):
+		with self.lock:
+			self.inFlight += 1
+
+	def end(self, seconds, ok, sheets = 0, bytesIn = 0, bytesOut = 0):
+		with self.lock:
+			self.inFlight -= 1
+			self.requests += 1
+			if not ok:
+				self.failures += 1
+			self.sheets += sheets
+			self.bytesIn += bytesIn
+			self.bytesOut += bytesOut
+			self.latencies.append(seconds)
+
+	def report(self):
+		with self.lock:
+			uptime = time.time() - self.started
+			latencies = sorted(self.latencies)
+			report = { \
+				'uptimeSeconds':round(uptime, 3), \
+				'requests':self.requests, \
+				'failures':self.failures, \
+				'inFlight':self.inFlight, \
+				'sheets':self.sheets, \
+				'bytesIn':self.bytesIn, \
+				'bytesOut':self.bytesOut, \
+				'requestsPerSecond':round(self.requests / uptime, 3) \
+					if uptime > 0 else 0.0 \
+			}
+		latency = {'count':len(latencies)}
+		if len(latencies) > 0:
+			at = lambda p: latencies[int(round(p * (len(latencies) - 1)))]
+			latency.update({ \
+				'mean':round(sum(latencies) / len(latencies), 6), \
+				'p50':round(at(0.50), 6), \
+				'p95':round(at(0.95), 6), \
+				'p99':round(at(0.99), 6), \
+				'max':round(latencies[-1], 6) \
+			})
+		report['latencySeconds'] = latency
+		return report
+
+# Errors in what was uploaded, as opposed to in the service
+uploadErrors = (InvalidVersion, InvalidCSVCurrency, OverflowException, \
+	csv.Error, locale.Error, ValueError)
+
+# A long-running HTTP conversion service, so that a portal converting
+# one upload at a time doesn't pay for starting Python, importing xlwt
+# and reading the template on every one. The template is loaded once,
+# before jobs worker processes are forked, and each request is handed to
+# the next free worker while the server thread that took it waits, so
+# that conversions aren't held to one core by the GIL. Requests:
+#   POST /convert?name=<name>[&currency=..][&uplift=..][&locale=..][&dump=..]
+#     with the dump as the body; answers with a zip of the sheets.
+#   GET /metrics: ServiceMetrics.report() as JSON.
+# Neither a ProcessedExpenseIndex nor an ExpenseHistory is kept.
+def conversionServer(address, template, currency = 'USD', uplift = 0.0, \
+		locale = 'en_US', options = None):
+	import BaseHTTPServer, SocketServer, json, multiprocessing, urlparse
+	if not isinstance(template, ExpenseTemplate):
+		template = ExpenseTemplate(template)
+	if options == None:
+		options = ConvertOptions()
+	jobs = options.jobs
+	workerOptions = ConvertOptions(columnar = options.columnar, \
+		packing = options.packing, duplicates = options.duplicates, \
+		duplicateDays = options.duplicateDays, \
+		duplicateAmount = options.duplicateAmount)
+	workerTemplates[template.fnBlankSpreadsheet] = template
+	pool = multiprocessing.Pool(jobs, resetServiceWorker)
+	metrics = ServiceMetrics()
+	defaults = {'currency':currency, 'uplift':str(uplift), 'locale':locale, \
+		'dump':'expenses.csv'}
+
+	class ConversionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+		def reply(self, status, body, contentType, headers = {}):
+			self.send_response(status)
+			self.send_header('Content-Type', contentType)
+			self.send_header('Content-Length', str(len(body)))
+			for header, value in headers.items():
+				self.send_header(header, value)
+			self.end_headers()
+			self.wfile.write(body)
+
+		def replyError(self, status, message):
+			self.reply(status, message + '\n', 'text/plain')
+
+		def do_GET(self):
+			if urlparse.urlparse(self.path).path != '/metrics':
+				return self.replyError(404, 'Not found')
+			self.reply(200, json.dumps(metrics.report(), indent = 2, \
+				sort_keys = True) + '\n', 'application/json')
+
+		def do_POST(self):
+			url = urlparse.urlparse(self.path)
+			if url.path != '/convert':
+				return self.replyError(404, 'Not found')
+			if self.headers.getheader('Content-Length') == None:
+				return self.replyError(411, 'Content-Length required')
+			try:
+				length = int(self.headers.getheader('Content-Length'))
+			except ValueError:
+				length = -1
+			if length < 0:
+				return self.replyError(400, 'Content-Length must be a length')
+			data = self.rfile.read(length)
+			params = dict(defaults)
+			params.update((key, values[-1]) for key, values in \
+				urlparse.parse_qs(url.query).items())
+			# the dump's name goes into response headers and file names
+			fnDump = params['dump']
+			if 'name' not in params or serviceDumpNameRe.match(fnDump) == None:
+				return self.replyError(400, 'name is required, and dump must ' \
+					'be a file name of letters, digits and ._@+- ending in .csv')
+
+			metrics.begin()
+			started = time.time()
+			fnOutputSheets = []
+			body = ''
+			ok = False
+			try:
+				config = ReportConfig(params['name'], params['currency'], \
+					float(params['uplift']), params['locale'])
+				fnOutputSheets, body = pool.apply(convertUpload, \
+					(template.fnBlankSpreadsheet, data, fnDump, config, \
+					workerOptions))
+			except uploadErrors as ex:
+				self.replyError(400, '%s: %s' % (type(ex).__name__, str(ex)))
+			except Exception as ex:
+				self.replyError(500, '%s: %s' % (type(ex).__name__, str(ex)))
+			else:
+				ok = True
+				self.reply(200, body, 'application/zip', { \
+					'Content-Disposition':'attachment; filename="%s.zip"' \
+						% os.path.splitext(fnDump)[0], \
+					'X-Sheets':', '.join(fnOutputSheets) \
+				})
+			finally:
+				metrics.end(time.time() - started, ok, \
+					len(fnOutputSheets), len(data), len(body))
+
+	class ConversionServer(SocketServer.ThreadingMixIn, \
+			BaseHTTPServer.HTTPServer):
+		daemon_threads = True
+		allow_reuse_address = True
+
+		def server_close(self):
+			BaseHTTPServer.HTTPServer.server_close(self)
+			pool.close()
+			pool.join()
+
+	server = ConversionServer(address, ConversionRequestHandler)
+	server.metrics = metrics
+	return server
+
+serviceDumpNameRe = re.compile(r'[\w.@+-]+\.csv\Z')
+
+# "[host:]port", host being localhost if it's left out
+def serviceAddress(address):
+	host, _, port = address.rpartition(':')
+	return (host if host != '' else '127.0.0.1', int(port))
+
+def main(argv):
+	try:
+		opts, args = getopt.getopt(argv[1:],"hl:c:u:b:j:", \
+			["jobs=", "template-cache=", "columnar", "ingest-jobs=", \
+			"packing=", "since-last-run=", "dry-run", \
+			"profile=", "profile-format=", "pipeline", "zip=", \
+			"duplicates=", "duplicate-days=", "duplicate-amount=", \
+			"duplicate-history=", "validate", "serve=", "layouts=", "layout=", \
+			"shard=", "shard-by=", "shard-period=", "shard-buffer="])
+	except getopt.GetoptError:
+		print getUsage(argv[0])
+		sys.exit(2)
+
+	# Defaults
+	expensifyLocale = 'en_US'
+	homeCurrency = 'USD'
+	currencyUplift = 0.0
+	fnManifest = None
+	options = ConvertOptions()
+	templateCacheDir = None
+	dryRun = False
+	validate = False
+	serveAddress = None
+	fnProfile = None
+	profileFormat = 'json'
+	layoutDirs = []
+	layoutName = None
+	fnExport = None
+	shardColumn = 'Employee'
+	shardPeriod = 'month'
+	shardBuffer = 100000
+
+	for opt, arg in opts:
+		if opt == '-h':
+			print getUsage(argv[0])
+			sys.exit()
+		elif opt == "-l":
+			expensifyLocale = arg
+		elif opt == "-c":
+			homeCurrency = arg
+		elif opt == "-u":
+			currencyUplift = float(arg)
+		elif opt == "-b":
+			fnManifest = arg
+		elif opt in ("-j", "--jobs"):
+			options.jobs = int(arg)
+		elif opt == "--template-cache":
+			templateCacheDir = arg
+		elif opt == "--columnar":
+			options.columnar = True
+		elif opt == "--ingest-jobs":
+			options.ingestJobs = int(arg)
+		elif opt == "--pipeline":
+			options.pipeline = True
+		elif opt == "--zip":
+			options.archive = arg
+		elif opt == "--duplicates":
+			if arg not in ConvertOptions.duplicateModes:
+				print getUsage(argv[0])
+				sys.exit(2)
+			options.duplicates = arg
+		elif opt == "--duplicate-days":
+			options.duplicateDays = int(arg)
+		elif opt == "--duplicate-amount":
+			options.duplicateAmount = float(arg)
+		elif opt == "--duplicate-history":
+			options.duplicateHistory = arg
+		elif opt == "--packing":
+			if arg not in ConvertOptions.packingModes:
+				print getUsage(argv[0])
+				sys.exit(2)
+			options.packing = arg
+		elif opt == "--since-last-run":
+			options.sinceLastRun = arg
+		elif opt == "--dry-run":
+			dryRun = True
+		elif opt == "--validate":
+			validate = True
+		elif opt == "--serve":
+			serveAddress = serviceAddress(arg)
+		elif opt == "--layouts":
+			layoutDirs.append(arg)
+		elif opt == "--layout":
+			layoutName = arg
+		elif opt == "--shard":
+			fnExport = arg
+		elif opt == "--shard-by":
+			shardColumn = arg
+		elif opt == "--shard-period":
+			if arg not in shardPeriods:
+				print getUsage(argv[0])
+				sys.exit(2)
+			shardPeriod = arg
+		elif opt == "--shard-buffer":
+			shardBuffer = int(arg)
+		elif opt == "--profile":
+			fnProfile = arg
+		elif opt == "--profile-format":
+			if arg not in profilerFormats:
+				print getUsage(argv[0])
+				sys.exit(2)
+			profileFormat = arg
+
+	# alongside the built-in layouts, and replacing any of the same name
+	for dirLayouts in layoutDirs:
+		getReportLayouts()
+		loadReportLayouts(dirLayouts)
+	if layoutName != None and layoutName not in getReportLayouts():
+		print 'No "%s" report layout loaded' % layoutName
+		print getUsage(argv[0])
+		sys.exit(2)
+
+	# keeping a history is no use without looking in it
+	if options.duplicateHistory != None and options.duplicates == None:
+		options.duplicates = 'flag'
+
+	# the service takes its names and dumps one request at a time
+	if serveAddress != None:
+		if len(args) != 1:
+			print getUsage(argv[0])
+			sys.exit(2)
+		server = conversionServer(serveAddress, \
+			ExpenseTemplate(args[0], templateCacheDir), homeCurrency, \
+			currencyUplift, expensifyLocale, options)
+		print "Serving on http://%s:%d/" % server.server_address
+		sys.stdout.flush()
+		# stopped with ^C or kill alike
+		import signal
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+		return
+
+	# profile everything from here on, sharding included
+	if fnProfile != None:
+		startProfiling()
+
+	# a dry run or validation doesn't need input_sheet
+	needSheet = not (dryRun or validate)
+	if fnManifest != None or fnExport != None:
+		if (len(args) < 1 and needSheet) or \
+				(fnManifest != None and fnExport != None):
+			print getUsage(argv[0])
+			sys.exit(2)
+		if fnExport != None:
+			if os.path.splitext(fnExport)[1] != ".csv":
+				print "expensify_export file must end in .csv"
+				print getUsage(argv[0])
+				sys.exit(2)
+			# the shards go in a directory named after the export
+			manifest = shardExport(fnExport, os.path.splitext(fnExport)[0], \
+				shardColumn, shardPeriod, shardBuffer)
+		else:
+			manifest = readManifest(fnManifest)
+		dumps = [fnExpensifyDump for (name, dump, fnBlankSpreadsheet) \
+			in map(manifestEntry, manifest) \
+			for fnExpensifyDump in expensifyDumps(dump)]
+		fnBlankSpreadsheet = args[0] if len(args) > 0 else None
+	else:
+		# <name> <expensify_dump>... [<input_sheet>]
+		fnBlankSpreadsheet = None
+		if len(args) > 2 and os.path.splitext(args[-1])[1] != ".csv":
+			fnBlankSpreadsheet = args.pop()
+		if len(args) < 2 or (fnBlankSpreadsheet == None and needSheet):
+			print getUsage(argv[0])
+			sys.exit(2)
+		dumps = args[1:]
+		manifest = [(args[0], dumps[0] if len(dumps) == 1 else dumps)]
+
+	for fnExpensifyDump in dumps:
+		if os.path.splitext(fnExpensifyDump)[1] != ".csv":
+			print "expensify_dump file must end in .csv"
+			print getUsage(argv[0])
+			sys.exit(2)
+
+	try:
+		if validate:
+			problemCount = 0
+			for name, dump, fnBlankSpreadsheet in map(manifestEntry, manifest):
+				config = ReportConfig(name, homeCurrency, currencyUplift, \
+					expensifyLocale)
+				for fn, line, field, message in validateDump(dump, config):
+					problemCount += 1
+					if field == None:
+						print "%s:%d: %s" % (fn, line, message)
+					else:
+						print "%s:%d: %s: %s" % (fn, line, field, message)
+			print "%d problems in %s" % (problemCount, \
+				', '.join(dumps))
+			if problemCount > 0:
+				sys.exit(1)
+			return
+
+		if dryRun:
+			import json
+			# messages along the way go to stderr, leaving stdout for the JSON
+			stdout = sys.stdout
+			sys.stdout = sys.stderr
+			try:
+				# input_sheet, if given, only says which layout to pack for,
+				# and what type of sheets would come out
+				layout = None
+				extension = '.xls'
+				if fnBlankSpreadsheet != None:
+					layout = inputSheetLayout(fnBlankSpreadsheet)
+					extension = outputBackend(fnBlankSpreadsheet).extension
+				elif layoutName != None:
+					layout = reportLayout(layoutName)
+				summaries = summarizeBatch(manifest, homeCurrency, \
+					currencyUplift, expensifyLocale, options, layout, extension)
+			finally:
+				sys.stdout = stdout
+			json.dump({'reports':summaries}, sys.stdout, indent = 2, \
+				sort_keys = True)
+			print
+			if any(summary['error'] != None for summary in summaries):
+				sys.exit(1)
+			return
+
+		template = ExpenseTemplate(fnBlankSpreadsheet, templateCacheDir)
+		results = convertBatch(manifest, template, homeCurrency, \
+			currencyUplift, expensifyLocale, options)
+
+		for name, dump, fnOutputSheets, error in results:
+			if error == None and len(fnOutputSheets) == 0:
+				print "No new expenses for %s (%s)" % (name, \
+					', '.join(expensifyDumps(dump)))
+
+		failures = [(name, dump, error) for (name, dump, fnOutputSheets, error) \
+			in results if error != None]
+		if len(failures) > 0:
+			print "%d of %d reports failed:" % (len(failures), len(results))
+			for name, dump, error in failures:
+				print "  %s (%s): %s: %s" % (name, \
+					', '.join(expensifyDumps(dump)), \
+					type(error).__name__, str(error))
+			sys.exit(1)
+	finally:
+		if fnProfile != None:
+			profiler.writeReport(fnProfile, profileFormat)
+
+if __name__ == '__main__':
+	main(sys.argv)